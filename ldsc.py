@@ -12,11 +12,15 @@ import ldscore.ldscore as ld
 import ldscore.parse as ps
 import ldscore.sumstats as sumstats
 import ldscore.regressions as reg
+import ldscore.output as output
 import numpy as np
 import pandas as pd
 import functools
-from subprocess import call
+import hashlib
+import os
 from itertools import product
+from multiprocessing import Pool
+from scipy import sparse
 import time, sys, traceback, argparse
 
 
@@ -67,18 +71,18 @@ class Logger(object):
 
     '''
     def __init__(self, fh):
-        self.log_fh = open(fh, 'wb')
+        self.log_fh = open(fh, 'w')
 
     def log(self, msg):
         '''
         Print to log file and stdout with a single command.
 
         '''
-        print(self.log_fh, msg)
+        print(msg, file=self.log_fh)
         print(msg)
 
 
-def __filter__(fname, noun, verb, merge_obj, num):
+def __filter__(fname, noun, verb, merge_obj):
     merged_list = None
     if fname:
         f = lambda x,n: x.format(noun=noun, verb=verb, fname=fname, num=n)
@@ -110,6 +114,48 @@ def annot_sort_key(s):
 
     return s
 
+def _annot_name(fh, chr=None):
+    '''
+    Name of the set of LD Scores computed from the .annot file fh. If chr is not None, the
+    chromosome number is removed from files named <name>.<chr>.annot[.gz/.bz2], since it is
+    already part of the output prefix.
+
+    '''
+    name = os.path.basename(fh)
+    for suffix in ['.gz', '.bz2', '.annot']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if chr is not None and name.endswith('.' + str(chr)):
+        name = name[:-len(str(chr)) - 1]
+
+    return name
+
+
+def _annot_files(annot, chr=None):
+    '''
+    Splits --annot into a list of .annot files. --annot is either a comma-separated list of
+    files or a directory, in which case all .annot[.gz/.bz2] files in the directory are
+    used. If chr is not None, only files named <name>.<chr>.annot[.gz/.bz2] are used.
+
+    '''
+    if not os.path.isdir(annot):
+        return annot.split(',')
+
+    fhs = [os.path.join(annot, f) for f in sorted(os.listdir(annot))
+           if f.endswith(('.annot', '.annot.gz', '.annot.bz2'))]
+    if chr is not None:
+        fhs = [fh for fh in fhs if _annot_name(fh).split('.')[-1] == str(chr)]
+    if len(fhs) == 0:
+        raise ValueError('No .annot files in {D}.'.format(D=annot))
+
+    return fhs
+
+
+def _annot_per_file(annot):
+    '''Is --annot a list or directory of .annot files, written to [--out].[name] each?'''
+    return os.path.isdir(annot) or ',' in annot
+
+
 def ldscore(args, log):
     '''
     Wrapper function for estimating l1, l1^2, l2 and l4 (+ optionally standard errors) from
@@ -129,21 +175,37 @@ def ldscore(args, log):
     array_snps = snp_obj(snp_file)
     m = len(array_snps.IDList)
     log.log('Read list of {m} SNPs from {f}'.format(m=m, f=snp_file))
+    # annot_sets: output prefix and annot_matrix columns of each set of LD Scores
+    annot_sets = [(args.out, slice(None))]
     if args.annot is not None:  # read --annot
-        try:
-            annot = ps.AnnotFile(args.annot)
-            n_annot, ma = len(annot.df.columns) - 4, len(annot.df)
-            log.log("Read {A} annotations for {M} SNPs from {f}".format(f=args.annot,
-                A=n_annot, M=ma))
-            annot_matrix = np.array(annot.df.iloc[:,4:])
-            annot_colnames = annot.df.columns[4:]
-            keep_snps = None
-            if np.any(annot.df.SNP.values != array_snps.df.SNP.values):
-                raise ValueError('The .annot file must contain the same SNPs in the same'+\
-                    ' order as the .bim file.')
-        except Exception:
-            log.log('Error parsing .annot file')
-            raise
+        # ldscore_chr sets annot_chr to select the files of one chromosome of a directory
+        annot_chr = getattr(args, 'annot_chr', None)
+        annot_files = _annot_files(args.annot, annot_chr)
+        annot_matrix, annot_colnames = [], []
+        per_file = _annot_per_file(args.annot)
+        if per_file:
+            annot_sets = []
+        for fh in annot_files:
+            try:
+                annot = ps.AnnotFile(fh)
+                n_annot, ma = len(annot.df.columns) - 4, len(annot.df)
+                log.log("Read {A} annotations for {M} SNPs from {f}".format(f=fh,
+                    A=n_annot, M=ma))
+                if per_file:
+                    annot_sets.append((args.out + '.' + _annot_name(fh, annot_chr),
+                        slice(len(annot_colnames), len(annot_colnames) + n_annot)))
+                annot_matrix.append(np.array(annot.df.iloc[:,4:]))
+                annot_colnames.extend(annot.df.columns[4:])
+                keep_snps = None
+                if np.any(annot.df.SNP.values != array_snps.df.SNP.values):
+                    raise ValueError('The .annot file must contain the same SNPs in the same'+\
+                        ' order as the .bim file.')
+            except Exception:
+                log.log('Error parsing .annot file {F}'.format(F=fh))
+                raise
+
+        annot_matrix = np.hstack(annot_matrix)
+        n_annot = len(annot_colnames)
 
     elif args.extract is not None:  # --extract
         keep_snps = __filter__(args.extract, 'SNPs', 'include', array_snps)
@@ -259,6 +321,9 @@ def ldscore(args, log):
     if annot_matrix is not None:
         annot_keep = geno_array.kept_snps
         annot_matrix = annot_matrix[annot_keep,:]
+        if args.annot is not None and np.count_nonzero(annot_matrix) < 0.1*annot_matrix.size:
+            log.log('Annotations are sparse, using sparse annotation matrix.')
+            annot_matrix = sparse.csr_matrix(annot_matrix)
 
     # determine block widths
     x = np.array((args.ld_wind_snps, args.ld_wind_kb, args.ld_wind_cm), dtype=bool)
@@ -291,13 +356,68 @@ def ldscore(args, log):
         pq = np.matrix(geno_array.maf*(1-geno_array.maf)).reshape((geno_array.m, 1))
         pq = np.power(pq, args.pq_exp)
 
-        if annot_matrix is not None:
+        if sparse.issparse(annot_matrix):
+            annot_matrix = sparse.csr_matrix(annot_matrix.multiply(pq))
+        elif annot_matrix is not None:
             annot_matrix = np.multiply(annot_matrix, pq)
         else:
             annot_matrix = pq
 
+    dtype = np.float64
+    if args.float32:
+        dtype = np.float32
+        s, e, dev = geno_array.ldScoreDeviation(block_left, args.chunk_size, annot=annot_matrix)
+        log.log('Computing LD Score in single precision. Maximum deviation from double '
+                'precision on SNPs {S}-{E}: {D}'.format(S=s+1, E=e, D=dev))
+
+    checkpoint = None
+    if args.checkpoint_every is not None:
+        checkpoint = ld.Checkpoint(args.out + '.l2.ckpt.npz', args.checkpoint_every,
+            _checkpoint_key(args, geno_array, block_left, annot_matrix), resume=args.resume)
+        if checkpoint.state is not None:
+            log.log('Resuming from checkpoint {F} at SNP {S}.'.format(F=checkpoint.fname,
+                S=checkpoint.state['l_B']+1))
+
     log.log("Estimating LD Score.")
-    lN = geno_array.ldScoreVarBlocks(block_left, args.chunk_size, annot=annot_matrix)
+    lN = geno_array.ldScoreVarBlocks(block_left, args.chunk_size, annot=annot_matrix,
+        n_segments=args.n_segments, dtype=dtype, checkpoint=checkpoint)
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    if args.annot is not None and len(annot_sets) > 1:
+        log.log('Writing LD Scores for {N} annotation files.'.format(N=len(annot_sets)))
+
+    for out, cols in annot_sets:
+        if annot_matrix is None:
+            _write_ldscore(args, log, out, geno_array, lN, None, None, scale_suffix)
+        else:
+            _write_ldscore(args, log, out, geno_array, lN[:, cols], annot_matrix[:, cols],
+                annot_colnames[cols], scale_suffix)
+
+
+def _checkpoint_key(args, geno_array, block_left, annot_matrix):
+    '''Fingerprint of the inputs to ldScoreVarBlocks, for checking --resume.'''
+    h = hashlib.sha1()
+    h.update(str((geno_array.n, geno_array.m, args.chunk_size, args.float32)).encode())
+    for x in [geno_array.kept_snps, geno_array.freq, block_left]:
+        h.update(np.ascontiguousarray(x).tobytes())
+    if sparse.issparse(annot_matrix):
+        for x in [annot_matrix.data, annot_matrix.indices, annot_matrix.indptr]:
+            h.update(np.ascontiguousarray(x).tobytes())
+    elif annot_matrix is not None:
+        h.update(np.ascontiguousarray(annot_matrix, dtype=float).tobytes())
+
+    return h.hexdigest()
+
+
+def _write_ldscore(args, log, out, geno_array, lN, annot_matrix, annot_colnames, scale_suffix):
+    '''
+    Writes the LD Scores lN (one column per annotation in annot_matrix) to out.l2.ldscore.gz,
+    the numbers of SNPs per annotation to out.l2.M and out.l2.M_5_50, and summaries of the
+    LD Scores and annotations to the log.
+
+    '''
+    n_annot = lN.shape[1]
     col_prefix = "L2"; file_suffix = "l2"
 
     if n_annot == 1:
@@ -306,7 +426,7 @@ def ldscore(args, log):
         ldscore_colnames = [y+col_prefix+scale_suffix for y in annot_colnames]
 
     # print .ldscore. Output columns: CHR, BP, RS, [LD Scores]
-    out_fname = args.out + '.' + file_suffix + '.ldscore'
+    out_fname = out + '.' + file_suffix + '.ldscore'
     new_colnames = geno_array.colnames + ldscore_colnames
     df = pd.DataFrame.from_records(np.c_[geno_array.df, lN])
     df.columns = new_colnames
@@ -323,18 +443,22 @@ def ldscore(args, log):
                         F=args.print_snps, N=len(print_snps)))
 
         print_snps.columns = ['SNP']
-        df = df.ix[df.SNP.isin(print_snps.SNP), :]
+        df = df.loc[df.SNP.isin(print_snps.SNP), :]
         if len(df) == 0:
             raise ValueError('After merging with --print-snps, no SNPs remain.')
         else:
             msg = 'After merging with --print-snps, LD Scores for {N} SNPs will be printed.'
             log.log(msg.format(N=len(df)))
 
-    l2_suffix = '.gz'
-    log.log("Writing LD Scores for {N} SNPs to {f}.gz".format(f=out_fname, N=len(df)))
-    df.drop(['CM', 'MAF'], axis=1).to_csv(out_fname, sep="\t", header=True, index=False,
-        float_format='%.3f')
-    call(['gzip', '-f', out_fname])
+    if args.ldscore_format == 'npz':
+        l2_suffix = '.npz'
+        log.log("Writing LD Scores for {N} SNPs to {f}.npz".format(f=out_fname, N=len(df)))
+        ps.write_columnar(out_fname + l2_suffix, df.drop(['CM', 'MAF'], axis=1).infer_objects())
+    else:
+        l2_suffix = '.gz'
+        log.log("Writing LD Scores for {N} SNPs to {f}.gz".format(f=out_fname, N=len(df)))
+        output.write_csv_gz(df.drop(['CM', 'MAF'], axis=1), out_fname + l2_suffix,
+            threads=args.bgzf_threads, sep="\t", header=True, index=False, float_format='%.3f')
     if annot_matrix is not None:
         M = np.atleast_1d(np.squeeze(np.asarray(np.sum(annot_matrix, axis=0))))
         ii = geno_array.maf > 0.05
@@ -344,41 +468,41 @@ def ldscore(args, log):
         M_5_50 = [np.sum(geno_array.maf > 0.05)]
 
     # print .M
-    fout_M = open(args.out + '.' + file_suffix +'.M','wb')
-    print >>fout_M, '\t'.join(map(str,M))
+    fout_M = open(out + '.' + file_suffix +'.M','w')
+    print('\t'.join(map(str,M)), file=fout_M)
     fout_M.close()
 
     # print .M_5_50
-    fout_M_5_50 = open(args.out + '.'+ file_suffix + '.M_5_50','wb')
-    print >>fout_M_5_50, '\t'.join(map(str, M_5_50))
+    fout_M_5_50 = open(out + '.'+ file_suffix + '.M_5_50','w')
+    print('\t'.join(map(str, M_5_50)), file=fout_M_5_50)
     fout_M_5_50.close()
 
     # print annot matrix
     if (args.cts_bin is not None) and not args.no_print_annot:
-        out_fname_annot = args.out + '.annot'
+        out_fname_annot = out + '.annot'
         new_colnames = geno_array.colnames + ldscore_colnames
         annot_df = pd.DataFrame(np.c_[geno_array.df, annot_matrix])
         annot_df.columns = new_colnames
         del annot_df['MAF']
         log.log("Writing annot matrix produced by --cts-bin to {F}".format(F=out_fname+'.gz'))
-        annot_df.to_csv(out_fname_annot, sep="\t", header=True, index=False)
-        call(['gzip', '-f', out_fname_annot])
+        output.write_csv_gz(annot_df, out_fname_annot + '.gz', threads=args.bgzf_threads,
+            sep="\t", header=True, index=False)
 
     # print LD Score summary
     pd.set_option('display.max_rows', 200)
     log.log('\nSummary of LD Scores in {F}'.format(F=out_fname+l2_suffix))
-    t = df.ix[:,4:].describe()
-    log.log( t.ix[1:,:] )
+    t = df.iloc[:,4:].describe()
+    log.log( t.iloc[1:,:] )
 
     # print correlation matrix including all LD Scores and sample MAF
     log.log('')
     log.log('MAF/LD Score Correlation Matrix')
-    log.log(df.ix[:, 4:].corr())
+    log.log(df.iloc[:, 4:].corr())
 
     # print condition number
     if n_annot > 1: # condition number of a column vector w/ nonzero var is trivially one
         log.log('\nLD Score Matrix Condition Number')
-        cond_num = np.linalg.cond(df.ix[:, 5:])
+        cond_num = np.linalg.cond(df.iloc[:, 5:])
         log.log(reg.remove_brackets(str(np.matrix(cond_num))))
         if cond_num > 10000:
             log.log('WARNING: ill-conditioned LD Score Matrix!')
@@ -386,6 +510,8 @@ def ldscore(args, log):
     # summarize annot matrix if there is one
     if annot_matrix is not None:
         # covariance matrix
+        if sparse.issparse(annot_matrix):
+            annot_matrix = annot_matrix.toarray()
         x = pd.DataFrame(annot_matrix, columns=annot_colnames)
         log.log('\nAnnotation Correlation Matrix')
         log.log(x.corr())
@@ -400,13 +526,99 @@ def ldscore(args, log):
         log.log(_remove_dtype(row_sums))
 
 
+def _ldscore_worker(args):
+    '''Compute LD Scores for one chromosome of ldscore_chr, logging to args.out.log.'''
+    log = Logger(args.out + '.log')
+    try:
+        ldscore(args, log)
+    finally:
+        log.log_fh.close()
+
+    return args.out
+
+
+def _ldscore_mem(args, bfile):
+    '''Rough upper bound on the memory (in bytes) used by ldscore for one fileset.'''
+    array_snps = ps.PlinkBIMFile(bfile + '.bim')
+    n = len(ps.PlinkFAMFile(bfile + '.fam').IDList)
+    m = len(array_snps.IDList)
+    if args.ld_wind_snps:
+        block_left = ld.getBlockLefts(np.arange(m), args.ld_wind_snps)
+    elif args.ld_wind_kb:
+        block_left = ld.getBlockLefts(np.array(array_snps.df['BP']), args.ld_wind_kb*1000)
+    else:
+        block_left = ld.getBlockLefts(np.array(array_snps.df['CM']), args.ld_wind_cm)
+
+    max_window = np.max(np.arange(m) - block_left) + 2*args.chunk_size
+    return 8*(n*max_window + 16*m)
+
+
+def ldscore_chr(args, log):
+    '''
+    Estimate LD Scores for a --bfile fileset split across chromosomes, computing one
+    chromosome per worker process. The @ symbol in --bfile (and --annot and --out, if
+    present) is replaced with chromosome numbers, as with --ref-ld-chr. Without @ in
+    --out, chromosome numbers are appended to the output prefix. The logs of the
+    chromosomes are appended to the main log in chromosome order.
+
+    '''
+    chrs = [i for i in range(1, sumstats._N_CHR+1)
+            if os.path.exists(ps.sub_chr(args.bfile, i) + '.bed')]
+    if len(chrs) == 0:
+        raise ValueError('No .bed files matching {F}.'.format(F=ps.sub_chr(args.bfile, '[1-22]')))
+
+    log.log('Found .bed files for {N} chromosomes matching {F}.'.format(N=len(chrs),
+        F=ps.sub_chr(args.bfile, '[1-22]')))
+    mem = {i: _ldscore_mem(args, ps.sub_chr(args.bfile, i)) for i in chrs}
+    n_jobs = min(args.n_jobs, len(chrs))
+    if args.mem_limit is not None:
+        max_jobs = int(args.mem_limit*1024**3 // max(mem.values()))
+        if max_jobs < 1:
+            log.log('WARNING: the largest chromosome may need more than --mem-limit.')
+        n_jobs = max(min(n_jobs, max_jobs), 1)
+
+    log.log('Computing LD Scores with {N} worker processes.'.format(N=n_jobs))
+    chr_args = {}
+    for i in chrs:
+        chr_args[i] = argparse.Namespace(**vars(args))
+        chr_args[i].bfile = ps.sub_chr(args.bfile, i)
+        chr_args[i].out = ps.sub_chr(args.out, i)
+        if args.annot is not None and os.path.isdir(args.annot):
+            _annot_files(args.annot, i)  # raise here if chromosome i has no .annot files
+            chr_args[i].annot_chr = i
+        elif args.annot is not None and '@' in args.annot:
+            chr_args[i].annot = ps.sub_chr(args.annot, i)
+        if args.cts_bin is not None and '@' in args.cts_bin:
+            chr_args[i].cts_bin = ps.sub_chr(args.cts_bin, i)
+
+    pool = Pool(n_jobs)
+    try:
+        # start the largest chromosomes first, since they are on the critical path
+        results = {i: pool.apply_async(_ldscore_worker, (chr_args[i],))
+                   for i in sorted(chrs, key=lambda i: -mem[i])}
+        for i in chrs:
+            try:
+                results[i].get()
+            finally:
+                chr_log = chr_args[i].out + '.log'
+                if os.path.exists(chr_log):
+                    log.log('\n' + '-'*20 + ' Chromosome {C} '.format(C=i) + '-'*20)
+                    with open(chr_log) as f:
+                        log.log(f.read().rstrip())
+                    os.remove(chr_log)
+    finally:
+        pool.terminate()
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--out', default='ldsc', type=str,
     help='Output filename prefix. If --out is not set, LDSC will use ldsc as the '
     'defualt output filename prefix.')
 # Basic LD Score Estimation Flags'
 parser.add_argument('--bfile', default=None, type=str,
-    help='Prefix for Plink .bed/.bim/.fam file')
+    help='Prefix for Plink .bed/.bim/.fam file. If the prefix contains the symbol @, LDSC '
+    'will replace the @ symbol with chromosome numbers and estimate LD Scores for each '
+    'chromosome in parallel (see --n-jobs and --mem-limit).')
 parser.add_argument('--l2', default=False, action='store_true',
     help='Estimate l2. Compatible with both jackknife and non-jackknife.')
 # Filtering / Data Management for LD Score
@@ -434,7 +646,13 @@ parser.add_argument('--print-snps', default=None, type=str,
 parser.add_argument('--annot', default=None, type=str,
     help='Filename prefix for annotation file for partitioned LD Score estimation. '
     'LDSC will automatically append .annot or .annot.gz to the filename prefix. '
-    'See docs/file_formats_ld for a definition of the .annot format.')
+    'See docs/file_formats_ld for a definition of the .annot format. '
+    'A comma-separated list of .annot files, or a directory of .annot files, is estimated '
+    'in a single pass over the genotypes, and the LD Scores for each file are written to '
+    '[--out].[file name without .annot]. With a directory and --bfile split across '
+    'chromosomes, the files of chromosome @ must be named [name].@.annot[.gz], and their '
+    'LD Scores are written to [--out for chromosome @].[name], so that --ref-ld-chr '
+    '[--out].[name] reads them if --out contains @.')
 parser.add_argument('--cts-bin', default=None, type=str,
     help='This flag tells LDSC to compute partitioned LD Scores, where the partition '
     'is defined by cutting one or several continuous variable[s] into bins. '
@@ -470,9 +688,22 @@ parser.add_argument('--maf', default=None, type=float,
 parser.add_argument('--h2', default=None, type=str,
     help='Filename prefix for a .chisq file for one-phenotype LD Score regression. '
     'LDSC will automatically append .chisq or .chisq.gz to the filename prefix.'
-    '--h2 requires at minimum also setting the --ref-ld and --w-ld flags.')
+    '--h2 requires at minimum also setting the --ref-ld and --w-ld flags. '
+    'A comma-separated list of files estimates h2 for each of them, reading the '
+    'reference LD Scores only once (see --h2-manifest).')
+parser.add_argument('--h2-manifest', default=None, type=str,
+    help='File with one summary statistics file per line, for estimating h2 for many traits. '
+    'The reference LD Scores are read once, the traits are run in --n-jobs worker '
+    'processes, and a table with one row per trait is written to [--out].h2.results.')
 parser.add_argument('--rg', default=None, type=str,
     help='Comma-separated list of prefixes of .chisq filed for genetic correlation estimation.')
+parser.add_argument('--rg-matrix', default=None, type=str,
+    help='Comma-separated list of prefixes of summary statistics files. Estimates rg between '
+    'all pairs of traits, estimating h2 only once per trait, and writes the rg and gencov '
+    'matrices and their standard errors to [--out].[rg/rg_se/gencov/gencov_se]. Only SNPs '
+    'present in all traits are used, and --chisq-max removes a SNP from all traits, so '
+    'entries can differ from pairwise --rg when traits have different sets of SNPs. Pairs '
+    'are run in --n-jobs worker processes.')
 parser.add_argument('--ref-ld', default=None, type=str,
     help='Use --ref-ld to tell LDSC which LD Scores to use as the predictors in the LD '
     'Score regression. '
@@ -510,6 +741,11 @@ parser.add_argument('--two-step', default=None, type=float,
     help='Test statistic bound for use with the two-step estimator. Not compatible with --no-intercept and --constrain-intercept.')
 parser.add_argument('--chisq-max', default=None, type=float,
     help='Max chi^2.')
+parser.add_argument('--irwls-tol', default=None, type=float,
+    help='Stop IRWLS reweighting when the relative change in the regression weights is at '
+    'most this value. By default, IRWLS always does --irwls-max-iter passes.')
+parser.add_argument('--irwls-max-iter', default=2, type=int,
+    help='Maximum number of IRWLS reweighting passes (default 2).')
 # Flags for both LD Score estimation and h2/gencor estimation
 parser.add_argument('--print-cov', default=False, action='store_true',
     help='For use with --h2/--rg. This flag tells LDSC to print the '
@@ -525,6 +761,32 @@ parser.add_argument('--chunk-size', default=50, type=int,
     help='Chunk size for LD Score calculation. Use the default.')
 parser.add_argument('--pickle', default=False, action='store_true',
     help='Store .l2.ldscore files as pickles instead of gzipped tab-delimited text.')
+parser.add_argument('--n-jobs', default=1, type=int,
+    help='Number of worker processes to use when --bfile is split across chromosomes, or '
+    'when estimating h2 for many traits.')
+parser.add_argument('--float32', default=False, action='store_true',
+    help='Compute genotype correlations for --l2 in single precision, which is about twice '
+    'as fast. LD Scores are summed in double precision, and the maximum deviation from '
+    'double precision on a sample window is printed to the log.')
+parser.add_argument('--n-segments', default=1, type=int,
+    help='Split each chromosome into this many segments and estimate their LD Scores in '
+    'parallel threads. The results are identical to estimating LD Scores without segments.')
+parser.add_argument('--checkpoint-every', default=None, type=int,
+    help='Save the progress of --l2 to [--out].l2.ckpt.npz every this many chunks, so '
+    'that an interrupted job can be continued with --resume.')
+parser.add_argument('--resume', default=False, action='store_true',
+    help='Continue --l2 from the checkpoint saved with --checkpoint-every. The checkpoint is '
+    'only used if the genotypes, annotations and LD window are the same.')
+parser.add_argument('--mem-limit', default=None, type=float,
+    help='Approximate memory budget (in GB) for LD Score estimation with --bfile split '
+    'across chromosomes. The number of worker processes is reduced to fit the budget.')
+parser.add_argument('--ldscore-format', default='txt', type=str, choices=['txt', 'npz'],
+    help='Format of .l2.ldscore files: gzipped tab-delimited text with 3 decimals (txt), or '
+    'binary columns with full precision (npz), which --ref-ld and --w-ld read without '
+    'parsing text.')
+parser.add_argument('--bgzf-threads', default=None, type=int,
+    help='Write gzipped output as block gzip (BGZF), compressed with this many threads. '
+    'BGZF files can be read like any other .gz file.')
 parser.add_argument('--yes-really', default=False, action='store_true',
     help='Yes, I really want to compute whole-chromosome LD Score.')
 parser.add_argument('--invert-anyway', default=False, action='store_true',
@@ -533,6 +795,13 @@ parser.add_argument('--n-blocks', default=200, type=int,
     help='Number of block jackknife blocks.')
 parser.add_argument('--not-M-5-50', default=False, action='store_true',
     help='This flag tells LDSC to use the .l2.M file instead of the .l2.M_5_50 file.')
+parser.add_argument('--ld-cache', default=None, type=str,
+    help='Directory for caching parsed --ref-ld, --w-ld and .M files in binary form, so that '
+    'later runs with the same reference files skip parsing them. Entries are keyed on the '
+    'names, sizes and modification times of the files.')
+parser.add_argument('--ld-cache-size', default=10, type=float,
+    help='Maximum size of --ld-cache in GB. The least recently used entries are deleted '
+    'when the cache is larger than this.')
 parser.add_argument('--return-silly-things', default=False, action='store_true',
     help='Force ldsc to return silly genetic correlation estimates.')
 parser.add_argument('--no-check-alleles', default=False, action='store_true',
@@ -558,7 +827,8 @@ if __name__ == '__main__':
     if args.out is None:
         raise ValueError('--out is required.')
 
-    log = Logger(args.out+'.log')
+    # with --bfile split across chromosomes, @ in --out is only substituted per chromosome
+    log = Logger(args.out.replace('@', '')+'.log')
     try:
         defaults = vars(parser.parse_args(''))
         opts = vars(args)
@@ -595,13 +865,33 @@ if __name__ == '__main__':
             if args.overlap_annot and not args.not_M_5_50:
                 if not (args.frqfile and args.ref_ld) or (args.frqfile_chr and args.ref_ld_chr):
                     raise ValueError ('Must set either --frqfile and --ref-ld or --frqfile-chr and --ref-ld-chr')
-
-
-            ldscore(args, log)
+            if args.n_jobs < 1:
+                raise ValueError('--n-jobs must be an integer >= 1.')
+            if args.n_segments < 1:
+                raise ValueError('--n-segments must be an integer >= 1.')
+            if args.resume and args.checkpoint_every is None:
+                raise ValueError('--resume requires --checkpoint-every.')
+            if args.checkpoint_every is not None and args.n_segments > 1:
+                raise ValueError('--checkpoint-every cannot be used with --n-segments.')
+
+            if '@' in args.bfile:
+                ldscore_chr(args, log)
+            else:
+                ldscore(args, log)
         # summary statistics
-        elif (args.h2 or args.rg) and (args.ref_ld or args.ref_ld_chr) and (args.w_ld or args.w_ld_chr):
-            if args.h2 is not None and args.rg is not None:
+        elif (args.h2 or args.h2_manifest or args.rg or args.rg_matrix) and (args.ref_ld or args.ref_ld_chr) and (args.w_ld or args.w_ld_chr):
+            if (args.h2 is not None or args.h2_manifest is not None) and args.rg is not None:
                 raise ValueError('Cannot set both --h2 and --rg.')
+            if sum(x is not None for x in (args.h2 or args.h2_manifest, args.rg, args.rg_matrix)) > 1:
+                raise ValueError('Cannot set more than one of --h2, --rg and --rg-matrix.')
+            if args.h2 is not None and args.h2_manifest is not None:
+                raise ValueError('Cannot set both --h2 and --h2-manifest.')
+            if args.n_jobs < 1:
+                raise ValueError('--n-jobs must be an integer >= 1.')
+            if args.irwls_max_iter < 1:
+                raise ValueError('--irwls-max-iter must be an integer >= 1.')
+            if args.irwls_tol is not None and args.irwls_tol < 0:
+                raise ValueError('--irwls-tol must be >= 0.')
             if args.ref_ld and args.ref_ld_chr:
                 raise ValueError('Cannot set both --ref-ld and --ref-ld-chr.')
             if args.w_ld and args.w_ld_chr:
@@ -609,8 +899,12 @@ if __name__ == '__main__':
             if (args.samp_prev is not None) != (args.pop_prev is not None):
                 raise ValueError('Must set both or neither of --samp-prev and --pop-prev.')
 
-            if args.rg:
+            if args.rg_matrix:
+                sumstats.estimate_rg_matrix(args, log)
+            elif args.rg:
                 sumstats.estimate_rg(args, log)
+            elif args.h2_manifest or ',' in args.h2:
+                sumstats.estimate_h2_batch(args, log)
             elif args.h2:
                 sumstats.estimate_h2(args, log)
 
@@ -621,7 +915,7 @@ if __name__ == '__main__':
             print('ldsc.py -h describes options.')
     except Exception:
         ex_type, ex, tb = sys.exc_info()
-        log.log( traceback.format_exc(ex) )
+        log.log( traceback.format_exc() )
         raise
     finally:
         log.log('Analysis finished at {T}'.format(T=time.ctime()) )
@@ -0,0 +1,114 @@
+'''
+This module encodes alleles as small integers, so that checking and flipping the alleles of
+millions of SNPs is array indexing rather than a Python set or dict lookup per SNP.
+
+A base is coded A=0, C=1, G=2, T=3, and anything else (indels, N, lower case, missing
+values) is coded 4. A string of n bases is coded in base 5, e.g., an allele pair A1A2 is
+5*A1 + A2 (0..24) and two allele pairs A1A2A1xA2x are 25*(5*A1 + A2) + 5*A1x + A2x
+(0..624). Strings with more or fewer than n characters get a code that contains a 4, so
+they are never valid. The tables below are indexed by these codes.
+
+'''
+from __future__ import division
+import numpy as np
+import pandas as pd
+import itertools as it
+
+# complementary bases
+COMPLEMENT = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
+# bases
+BASES = COMPLEMENT.keys()
+# true iff strand ambiguous
+STRAND_AMBIGUOUS = {''.join(x): x[0] == COMPLEMENT[x[1]]
+                    for x in it.product(BASES, BASES)
+                    if x[0] != x[1]}
+# SNPS we want to keep (pairs of alleles)
+VALID_SNPS = {x for x in map(lambda y: ''.join(y), it.product(BASES, BASES))
+              if x[0] != x[1] and not STRAND_AMBIGUOUS[x]}
+# T iff SNP 1 has the same alleles as SNP 2 (allowing for strand or ref allele flip).
+MATCH_ALLELES = {x for x in map(lambda y: ''.join(y), it.product(VALID_SNPS, VALID_SNPS))
+                 # strand and ref match
+                 if ((x[0] == x[2]) and (x[1] == x[3])) or
+                 # ref match, strand flip
+                 ((x[0] == COMPLEMENT[x[2]]) and (x[1] == COMPLEMENT[x[3]])) or
+                 # ref flip, strand match
+                 ((x[0] == x[3]) and (x[1] == x[2])) or
+                 ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]]))}  # strand and ref flip
+# T iff SNP 1 has the same alleles as SNP 2 w/ ref allele flip.
+FLIP_ALLELES = {''.join(x):
+                ((x[0] == x[3]) and (x[1] == x[2])) or  # strand match
+                # strand flip
+                ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]]))
+                for x in MATCH_ALLELES}
+
+_INVALID = 4
+# code of each unicode code point < 256
+_BASE_CODE = np.full(256, _INVALID, dtype=np.int16)
+for _i, _b in enumerate('ACGT'):
+    _BASE_CODE[ord(_b)] = _i
+
+
+def _table(strings, n):
+    '''Boolean lookup table of length 5**n that is True at the codes of strings.'''
+    table = np.zeros(5**n, dtype=bool)
+    table[encode(list(strings), n)] = True
+    return table
+
+
+def encode(x, n=2):
+    '''
+    Integer codes of an array of strings of n bases (see the module docstring).
+
+    Parameters
+    ----------
+    x : array-like of str
+        Alleles, e.g., a pd.Series of A1 + A2 (n=2) or A1 + A2 + A1x + A2x (n=4).
+    n : int
+        Number of bases per string.
+
+    Returns
+    -------
+    codes : np.ndarray of int16
+        Codes in 0..5**n - 1.
+
+    '''
+    # alleles take few distinct values, so encode the distinct values, then index
+    labels, uniques = pd.factorize(np.asarray(x, dtype=object))
+    # fixed-width unicode, one extra character wide so that longer strings are invalid
+    u = np.asarray(uniques, dtype=object).astype('U' + str(n + 1))
+    u = u.view(np.uint32).reshape((-1, n + 1))
+    b = _BASE_CODE[np.minimum(u, 255)]
+    b[:, n - 1][u[:, n] != 0] = _INVALID
+    codes = np.zeros(len(u) + 1, dtype=np.int16)
+    codes[-1] = 5**n - 1  # missing values (label -1), all bases invalid
+    for k in range(n):
+        codes[0:-1] = 5*codes[0:-1] + b[:, k]
+
+    return codes[labels]
+
+
+# indexed by the code of a pair of alleles
+VALID_TABLE = _table(VALID_SNPS, 2)
+# indexed by the code of two pairs of alleles
+MATCH_TABLE = _table(MATCH_ALLELES, 4)
+FLIP_TABLE = _table([x for x in FLIP_ALLELES if FLIP_ALLELES[x]], 4)
+
+
+def pair_codes(a1, a2):
+    '''Codes of the allele pairs A1A2, given arrays of A1 and A2.'''
+    return 5*encode(a1, 1) + encode(a2, 1)
+
+
+def valid(a):
+    '''Which allele pairs (strings A1A2) are strand-unambiguous SNPs?'''
+    return VALID_TABLE[encode(a, 2)]
+
+
+def match(alleles):
+    '''Which pairs of SNPs (strings A1A2A1xA2x) have matching alleles? See MATCH_ALLELES.'''
+    return MATCH_TABLE[encode(alleles, 4)]
+
+
+def flip(alleles):
+    '''Which pairs of SNPs (strings A1A2A1xA2x) have flipped ref alleles? See FLIP_ALLELES.'''
+    return FLIP_TABLE[encode(alleles, 4)]
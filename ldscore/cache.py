@@ -0,0 +1,150 @@
+'''
+This module contains an on-disk cache for parsed reference files (--ref-ld, --w-ld, --M),
+so that repeated runs of ldsc.py --h2 or --rg against the same reference panel don't have
+to parse and sort the same gzipped text files each time.
+
+'''
+
+from __future__ import division
+import numpy as np
+import pandas as pd
+import os
+import hashlib
+import zipfile
+import ldscore.parse as ps
+
+# increment to invalidate cache entries written by an older version of the parsers
+_CACHE_VERSION = 1
+
+
+def _fingerprint(kind, fnames):
+    '''
+    Cache key for the result of parsing fnames with the parser named kind. The key
+    depends on the path, size and modification time of each file, so an entry is never
+    used after any of the files has changed.
+
+    '''
+    h = hashlib.sha1()
+    h.update('{V}\n{K}\n'.format(V=_CACHE_VERSION, K=kind).encode())
+    for fname in fnames:
+        st = os.stat(fname)
+        h.update('{F}\t{S}\t{T}\n'.format(F=os.path.abspath(fname), S=st.st_size,
+                                          T=st.st_mtime_ns).encode())
+
+    return h.hexdigest()
+
+
+class RefCache(object):
+    '''
+    Content-addressed cache of parsed reference files, stored as binary .npz files in a
+    directory. Each entry holds the merged, sorted and deduplicated output of a parser
+    (a DataFrame or an array), keyed on the paths, sizes and mtimes of the files it was
+    parsed from. When the total size of the cache exceeds max_size, the least recently
+    used entries are deleted.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory (created if it does not exist).
+    max_size : float, optional
+        Maximum total size of the cache in bytes. None means no limit.
+
+    '''
+    def __init__(self, cache_dir, max_size=None):
+        if max_size is not None and max_size < 0:
+            raise ValueError('Maximum cache size must be >= 0.')
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def get(self, kind, fnames, parsefunc):
+        '''
+        Returns parsefunc(), from the cache if there is an entry for kind and fnames. Else
+        calls parsefunc and stores the result.
+
+        Parameters
+        ----------
+        kind : str
+            Name of the parser, including any options that change its output.
+        fnames : list of str
+            Files read by parsefunc.
+        parsefunc : function
+            Function with no arguments that returns a pd.DataFrame or np.ndarray.
+
+        Returns
+        -------
+        out : pd.DataFrame or np.ndarray
+            Output of parsefunc.
+        hit : bool
+            Was out read from the cache?
+
+        '''
+        fname = os.path.join(self.cache_dir, _fingerprint(kind, fnames) + '.npz')
+        try:
+            out = self.__read__(fname)
+            os.utime(fname, None)  # mark as recently used
+            return out, True
+        except (IOError, OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            pass  # missing or corrupt entries are cache misses
+
+        out = parsefunc()
+        self.__write__(fname, out)
+        self.evict(keep=fname)
+        return out, False
+
+    def __read__(self, fname):
+        with np.load(fname) as x:
+            if 'array' in x.files:
+                return x['array']
+
+        return ps.read_columnar(fname)
+
+    def __write__(self, fname, out):
+        # write to a temporary file and rename, so concurrent runs never see partial entries
+        tmp = '{F}.{P}.tmp'.format(F=fname, P=os.getpid())
+        try:
+            if isinstance(out, pd.DataFrame):
+                ps.write_columnar(tmp, out)
+            else:
+                with open(tmp, 'wb') as f:
+                    np.savez(f, array=out)
+
+            os.replace(tmp, fname)
+        except (IOError, OSError):  # a read-only or full cache is not an error
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def entries(self):
+        '''List of (mtime, size, fname) of cache entries, least recently used first.'''
+        out = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.npz'):
+                fname = os.path.join(self.cache_dir, f)
+                try:
+                    st = os.stat(fname)
+                except OSError:  # deleted by another process
+                    continue
+                out.append((st.st_mtime, st.st_size, fname))
+
+        return sorted(out)
+
+    def evict(self, keep=None):
+        '''Deletes least recently used entries (except keep) until the cache fits max_size.'''
+        if self.max_size is None:
+            return
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in entries:
+            if total <= self.max_size:
+                break
+            if fname == keep:
+                continue
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
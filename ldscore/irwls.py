@@ -6,8 +6,13 @@ Iterativey re-weighted least squares.
 '''
 from __future__ import division
 import numpy as np
+from scipy.linalg import cho_factor, cho_solve
 import ldscore.jackknife as jk
 
+# largest condition number of X^T W X for which IRWLS.wls solves the normal equations;
+# more ill-conditioned problems are solved with np.linalg.lstsq on the weighted data
+_MAX_COND = 1e10
+
 
 class IRWLS(object):
 
@@ -29,6 +34,11 @@ class IRWLS(object):
         inverse CVF scale.
     slow : bool
         Use slow block jackknife? (Mostly for testing)
+    tol : float, optional
+        Stop reweighting when the relative change in the weights is at most tol. If None,
+        always do max_iter reweighting passes.
+    max_iter : int
+        Maximum number of reweighting passes.
 
     Attributes
     ----------
@@ -44,6 +54,8 @@ class IRWLS(object):
         Covariance matrix of jackknifed estimate.
     delete_values : np.matrix with shape (n_blocks, p)
         Jackknife delete values.
+    n_iter : int
+        Number of reweighting passes.
 
     Methods
     -------
@@ -54,7 +66,8 @@ class IRWLS(object):
 
     '''
 
-    def __init__(self, x, y, update_func, n_blocks, w=None, slow=False, separators=None):
+    def __init__(self, x, y, update_func, n_blocks, w=None, slow=False, separators=None,
+                 tol=None, max_iter=2):
         n, p = jk._check_shape(x, y)
         if w is None:
             w = np.ones_like(y)
@@ -62,8 +75,8 @@ class IRWLS(object):
             raise ValueError(
                 'w has shape {S}. w must have shape ({N}, 1).'.format(S=w.shape, N=n))
 
-        jknife = self.irwls(
-            x, y, update_func, n_blocks, w, slow=slow, separators=separators)
+        jknife = self.irwls(x, y, update_func, n_blocks, w, slow=slow, separators=separators,
+                            tol=tol, max_iter=max_iter)
         self.est = jknife.est
         self.jknife_se = jknife.jknife_se
         self.jknife_est = jknife.jknife_est
@@ -71,9 +84,11 @@ class IRWLS(object):
         self.jknife_cov = jknife.jknife_cov
         self.delete_values = jknife.delete_values
         self.separators = jknife.separators
+        self.n_iter = jknife.n_iter
 
     @classmethod
-    def irwls(cls, x, y, update_func, n_blocks, w, slow=False, separators=None):
+    def irwls(cls, x, y, update_func, n_blocks, w, slow=False, separators=None, tol=None,
+              max_iter=2):
         '''
         Iteratively re-weighted least squares (IRWLS).
 
@@ -93,11 +108,17 @@ class IRWLS(object):
             Use slow block jackknife? (Mostly for testing)
         separators : list or None
             Block jackknife block boundaries (optional).
+        tol : float, optional
+            Stop reweighting when the relative change in the weights is at most tol. If None,
+            always do max_iter reweighting passes.
+        max_iter : int
+            Maximum number of reweighting passes.
 
         Returns
         -------
         jknife : jk.LstsqJackknifeFast
-            Block jackknife regression with the final IRWLS weights.
+            Block jackknife regression with the final IRWLS weights. The number of
+            reweighting passes is jknife.n_iter.
 
         '''
         (n, p) = x.shape
@@ -108,24 +129,32 @@ class IRWLS(object):
             raise ValueError(
                 'w has shape {S}. w must have shape ({N}, 1).'.format(S=w.shape, N=n))
 
+        if max_iter < 1:
+            raise ValueError('max_iter must be >= 1.')
+
         w = np.sqrt(w)
-        for i in range(2):  # update this later
+        for n_iter in range(1, max_iter + 1):
             new_w = np.sqrt(update_func(cls.wls(x, y, w)))
             if new_w.shape != w.shape:
                 print ('IRWLS update:', new_w.shape, w.shape)
                 raise ValueError('New weights must have same shape.')
-            else:
-                w = new_w
 
-        x = cls._weight(x, w)
-        y = cls._weight(y, w)
+            change = cls._relative_change(new_w, w)
+            w = new_w
+            if tol is not None and change <= tol:
+                break
+
+        # the jackknife uses the weights from the last update, which no call to wls has seen,
+        # so its block values cannot be shared with the IRWLS iterations: each of the
+        # n_iter + 1 passes over x is with a different w
         if slow:
             jknife = jk.LstsqJackknifeSlow(
-                x, y, n_blocks, separators=separators)
+                cls._weight(x, w), cls._weight(y, w), n_blocks, separators=separators)
         else:
             jknife = jk.LstsqJackknifeFast(
-                x, y, n_blocks, separators=separators)
+                x, y, n_blocks, separators=separators, w=cls._normalize(w))
 
+        jknife.n_iter = n_iter
         return jknife
 
     @classmethod
@@ -133,6 +162,10 @@ class IRWLS(object):
         '''
         Weighted least squares.
 
+        Solves the normal equations X^T W X b = X^T W y by Cholesky decomposition, where
+        X^T W X and X^T W y are accumulated in chunks by jk.LstsqJackknifeFast.block_values.
+        If X^T W X is ill-conditioned, uses np.linalg.lstsq on the weighted data instead.
+
         Parameters
         ----------
         x : np.matrix with shape (n, p)
@@ -145,7 +178,8 @@ class IRWLS(object):
         Returns
         -------
         coef : list with four elements (coefficients, residuals, rank, singular values)
-            Output of np.linalg.lstsq
+            Output of np.linalg.lstsq. The normal equations do not give the residuals,
+            which are None.
 
         '''
         (n, p) = x.shape
@@ -156,9 +190,17 @@ class IRWLS(object):
             raise ValueError(
                 'w has shape {S}. w must have shape ({N}, 1).'.format(S=w.shape, N=n))
 
-        x = cls._weight(x, w)
-        y = cls._weight(y, w)
-        coef = np.linalg.lstsq(x, y, rcond=None)
+        xty, xtx = jk.LstsqJackknifeFast.block_values(x, y, [0, n], cls._normalize(w))
+        xty, xtx = xty.reshape((p, 1)), xtx[0]
+        ev = np.linalg.eigvalsh(xtx)
+        if ev[0] > 0 and ev[0] * _MAX_COND > ev[-1]:
+            try:
+                coef = cho_solve(cho_factor(xtx), xty)
+                return (coef, None, p, np.sqrt(ev[::-1]))
+            except np.linalg.LinAlgError:
+                pass
+
+        coef = np.linalg.lstsq(cls._weight(x, w), cls._weight(y, w), rcond=None)
         return coef
 
     @classmethod
@@ -184,13 +226,24 @@ class IRWLS(object):
             If any element of w is <= 0 (negative weights are not meaningful in WLS).
 
         '''
-        if np.any(w <= 0):
-            raise ValueError('Weights must be > 0')
         (n, p) = x.shape
         if w.shape != (n, 1):
             raise ValueError(
                 'w has shape {S}. w must have shape (n, 1).'.format(S=w.shape))
 
-        w = w / float(np.sum(w))
-        x_new = np.multiply(x, w)
+        x_new = np.multiply(x, cls._normalize(w))
         return x_new
+
+    @classmethod
+    def _relative_change(cls, new_w, w):
+        '''Relative change (in the Euclidean norm) from w to new_w, normalized to sum 1.'''
+        new_w, w = cls._normalize(new_w), cls._normalize(w)
+        return np.linalg.norm(new_w - w) / np.linalg.norm(w)
+
+    @classmethod
+    def _normalize(cls, w):
+        '''Normalize regression weights w to have sum 1, raising ValueError if any w <= 0.'''
+        if np.any(w <= 0):
+            raise ValueError('Weights must be > 0')
+
+        return w / float(np.sum(w))
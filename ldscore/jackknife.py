@@ -15,8 +15,18 @@ of the data.
 from __future__ import division
 import numpy as np
 from scipy.optimize import nnls
+from scipy.linalg import cho_factor, cho_solve
 np.seterr(divide='raise', invalid='raise')
 
+# largest condition number of X^T X (and of the k x k capacitance matrices) for which
+# LstsqJackknifeFast uses Woodbury downdates rather than solving each delete system
+_WOODBURY_MAX_COND = 1e8
+# rows of x multiplied by the weights at a time in LstsqJackknifeFast.block_values
+_CHUNK_SIZE = 8192
+# use Woodbury downdates for blocks with at most p / _WOODBURY_ROW_RATIO rows (measured
+# break-even with the stacked solve)
+_WOODBURY_ROW_RATIO = 4
+
 
 def _check_shape(x, y):
     '''Check that x and y have the correct shapes (for regression jackknives).'''
@@ -276,6 +286,8 @@ class LstsqJackknifeFast(Jackknife):
         Dependent variable.
     n_blocks : int
         Number of jackknife blocks
+    w : np.matrix with shape (n, 1), optional
+        Weights. If not None, regress y * w on x * w, without storing a weighted copy of x.
 
     Attributes
     ----------
@@ -300,34 +312,45 @@ class LstsqJackknifeFast(Jackknife):
         Computes whole-data estimate from block values.
     block_values_to_pseudovalues(block_values, est) :
         Computes pseudovalues and delete values in a single pass over the block values.
+    block_values_to_delete_values_woodbury(x, s, xty_block_values, xtx_block_values) :
+        Computes delete values by low-rank downdates of a single factorization of X^T X.
 
     '''
 
-    def __init__(self, x, y, n_blocks=None, separators=None):
+    def __init__(self, x, y, n_blocks=None, separators=None, w=None):
         Jackknife.__init__(self, x, y, n_blocks, separators)
-        xty, xtx = self.block_values(x, y, self.separators)
+        xty, xtx = self.block_values(x, y, self.separators, w)
         self.est = self.block_values_to_est(xty, xtx)
-        self.delete_values = self.block_values_to_delete_values(xty, xtx)
+        if _WOODBURY_ROW_RATIO * np.min(np.diff(self.separators)) <= self.p:
+            self.delete_values = self.block_values_to_delete_values_woodbury(
+                x, self.separators, xty, xtx, w)
+        else:
+            self.delete_values = self.block_values_to_delete_values(xty, xtx)
         self.pseudovalues = self.delete_values_to_pseudovalues(
             self.delete_values, self.est)
         (self.jknife_est, self.jknife_var, self.jknife_se, self.jknife_cov) =\
             self.jknife(self.pseudovalues)
 
     @classmethod
-    def block_values(cls, x, y, s):
+    def block_values(cls, x, y, s, w=None):
         '''
         Compute block values.
 
         Parameters
         ----------
         x : np.matrix with shape (n, p)
-            Independent variable.
+            Independent variable. Can be any object with a shape that returns arrays of
+            rows when sliced, e.g., regressions.LazyDesign, which is read _CHUNK_SIZE rows
+            at a time.
         y : np.matrix with shape (n, 1)
             Dependent variable.
         n_blocks : int
             Number of jackknife blocks
         s : list of ints
             Block separators.
+        w : np.matrix with shape (n, 1), optional
+            Weights. If not None, compute the block values of x * w and y * w, weighting
+            _CHUNK_SIZE rows at a time.
 
         Returns
         -------
@@ -346,11 +369,26 @@ class LstsqJackknifeFast(Jackknife):
         n_blocks = len(s) - 1
         xtx_block_values = np.zeros((n_blocks, p, p))
         xty_block_values = np.zeros((n_blocks, p))
+        # one BLAS product per block on views of x and y: this is faster than segment sums
+        # (np.add.reduceat) or batched matmul over padded blocks, which copy x
         for i in range(n_blocks):
-            xty_block_values[i, ...] = np.dot(
-                x[s[i]:s[i + 1], ...].T, y[s[i]:s[i + 1], ...]).reshape((1, p))
-            xtx_block_values[i, ...] = np.dot(
-                x[s[i]:s[i + 1], ...].T, x[s[i]:s[i + 1], ...])
+            if w is None and isinstance(x, np.ndarray):
+                x_block = x[s[i]:s[i + 1], ...]
+                xty_block_values[i, ...] = np.dot(
+                    x_block.T, y[s[i]:s[i + 1], ...]).reshape((1, p))
+                xtx_block_values[i, ...] = np.dot(x_block.T, x_block)
+                continue
+
+            # weighted or computed (e.g., regressions.LazyDesign) rows are copies
+            for j in range(s[i], s[i + 1], _CHUNK_SIZE):
+                k = min(j + _CHUNK_SIZE, s[i + 1])
+                # np.asarray: for np.matrix input, reshape(p) would still be (1, p)
+                x_chunk, y_chunk = np.asarray(x[j:k]), np.asarray(y[j:k, ...])
+                if w is not None:
+                    x_chunk = np.multiply(x_chunk, np.asarray(w[j:k, ...]))
+                    y_chunk = np.multiply(y_chunk, np.asarray(w[j:k, ...]))
+                xty_block_values[i, ...] += np.dot(x_chunk.T, y_chunk).ravel()
+                xtx_block_values[i, ...] += np.dot(x_chunk.T, x_chunk)
 
         return (xty_block_values, xtx_block_values)
 
@@ -414,14 +452,106 @@ class LstsqJackknifeFast(Jackknife):
 
         '''
         n_blocks, p = _check_shape_block(xty_block_values, xtx_block_values)
-        delete_values = np.zeros((n_blocks, p))
         xty_tot = np.sum(xty_block_values, axis=0)
         xtx_tot = np.sum(xtx_block_values, axis=0)
-        for j in range(n_blocks):
-            delete_xty = xty_tot - xty_block_values[j]
-            delete_xtx = xtx_tot - xtx_block_values[j]
-            delete_values[j, ...] = np.linalg.solve(
-                delete_xtx, delete_xty).reshape((1, p))
+        return cls._delete_solve(xty_tot, xtx_tot, xty_block_values, xtx_block_values)
+
+    @classmethod
+    def _delete_solve(cls, xty_tot, xtx_tot, xty_block_values, xtx_block_values):
+        '''Solves the delete systems of the given blocks in one stacked call.'''
+        n_blocks, p = xty_block_values.shape
+        delete_xty = np.asarray(xty_tot - xty_block_values)[..., np.newaxis]
+        delete_xtx = xtx_tot - xtx_block_values
+        return np.linalg.solve(delete_xtx, delete_xty).reshape((n_blocks, p))
+
+    @classmethod
+    def block_values_to_delete_values_woodbury(cls, x, s, xty_block_values,
+                                               xtx_block_values, w=None):
+        '''
+        Converts block values to delete values, factorizing A = X^T X only once.
+
+        If block b has k < p rows X_b, then the delete design matrix A - X_b^T X_b is a
+        rank-k downdate of A, and by the Sherman-Morrison-Woodbury identity
+
+            (A - X_b^T X_b)^{-1} = A^{-1} + A^{-1} X_b^T C_b^{-1} X_b A^{-1},
+
+        where C_b = I_k - X_b A^{-1} X_b^T. This costs O(p^2 k) per block given the Cholesky
+        factor of A, rather than O(p^3). Blocks with k > p / _WOODBURY_ROW_RATIO rows (for
+        which this is not faster), and blocks where A or C_b is ill-conditioned (condition
+        number > _WOODBURY_MAX_COND), are solved directly as in block_values_to_delete_values.
+
+        Parameters
+        ----------
+        x : np.matrix with shape (n, p)
+            Independent variable.
+        s : list of ints
+            Block separators.
+        xty_block_values : np.matrix with shape (n_blocks, p)
+            Block values of X^T Y.
+        xtx_block_values : 3D np.array with shape (n_blocks, p, p)
+            Block values of X^T X
+        w : np.matrix with shape (n, 1), optional
+            Weights, if the block values are of x * w (see block_values).
+
+        Returns
+        -------
+        delete_values : np.matrix with shape (n_blocks, p)
+            Delete Values.
+
+        Raises
+        ------
+        LinAlgError :
+            If delete design matrix is singular.
+        ValueError :
+            If the last two dimensions of xtx_block_values are not equal or if the first two
+        dimensions of xtx_block_values do not equal the shape of xty_block_values.
+
+        '''
+        n_blocks, p = _check_shape_block(xty_block_values, xtx_block_values)
+        if isinstance(x, np.matrix):
+            x = np.asarray(x)
+        s = np.asarray(s)
+        sizes = np.diff(s)
+        xty_block_values = np.asarray(xty_block_values)
+        xty_tot = np.sum(xty_block_values, axis=0)
+        xtx_tot = np.sum(xtx_block_values, axis=0)
+        direct = _WOODBURY_ROW_RATIO * sizes > p
+        if not np.all(direct):
+            ev = np.linalg.eigvalsh(xtx_tot)
+            try:
+                if ev[0] * _WOODBURY_MAX_COND <= ev[-1]:
+                    raise np.linalg.LinAlgError
+                chol = cho_factor(xtx_tot)
+            except np.linalg.LinAlgError:
+                direct[:] = True
+
+        delete_values = np.zeros((n_blocks, p))
+        if not np.all(direct):
+            # A^{-1} (X^T Y - X_b^T Y_b) for every block
+            d = cho_solve(chol, (xty_tot - xty_block_values).T).T
+            for k in np.unique(sizes[~direct]):
+                blocks = np.nonzero(~direct & (sizes == k))[0]
+                if k == 0:
+                    delete_values[blocks] = d[blocks]
+                    continue
+
+                rows = s[blocks, np.newaxis] + np.arange(k)
+                u = x[rows]  # X_b, shape (g, k, p)
+                if w is not None:
+                    u = u * np.asarray(w)[rows]
+                v = cho_solve(chol, u.reshape((-1, p)).T).T.reshape(u.shape)  # X_b A^{-1}
+                cap = np.eye(k) - np.matmul(u, v.transpose((0, 2, 1)))
+                # the eigenvalues of C_b are <= 1, so det(C_b) bounds the smallest from below
+                sign, logdet = np.linalg.slogdet(cap)
+                ok = (sign > 0) & (logdet > -np.log(_WOODBURY_MAX_COND))
+                z = np.linalg.solve(cap[ok], np.matmul(u[ok], d[blocks[ok], :, np.newaxis]))
+                delete_values[blocks[ok]] = d[blocks[ok]] + \
+                    np.matmul(v[ok].transpose((0, 2, 1)), z)[..., 0]
+                direct[blocks[~ok]] = True
+
+        if np.any(direct):
+            delete_values[direct] = cls._delete_solve(
+                xty_tot, xtx_tot, xty_block_values[direct], xtx_block_values[direct])
 
         return delete_values
 
@@ -1,6 +1,19 @@
 from __future__ import division
 import numpy as np
-import bitarray as ba
+import os
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+
+# genotype codes for the four 2-bit fields of a plink .bed byte, low-order bits first:
+# 00 -> 0, 01 -> 9 (missing), 10 -> 1, 11 -> 2
+_BED_CODES = np.array([0, 9, 1, 2], dtype=np.int8)
+_BED_LOOKUP = _BED_CODES[(np.arange(256).reshape((256, 1)) >> np.arange(0, 8, 2)) & 3]
+# popcounts of the low-order bits (A), high-order bits (B) and both bits (C = A & B) of
+# the 2-bit fields of a .bed byte, see PlinkBEDFile.__filter_snps_maf__
+_BED_POPCOUNT = np.array([[bin(x & 0x55).count('1'), bin(x & 0xaa).count('1'),
+    bin(x & (x >> 1) & 0x55).count('1')] for x in range(256)], dtype=np.int32)
+# number of bytes of packed genotypes to process at once in the MAF filter
+_FILTER_CHUNK_BYTES = 2**24
 
 
 def getBlockLefts(coords, max_dist):
@@ -10,27 +23,25 @@ def getBlockLefts(coords, max_dist):
 
     Parameters
     ----------
-    coords : np.array
-        Array of coordinates. Must be sorted.
-    max_dist : float
+    coords : np.array with shape (M, ) or (M, k)
+        Array of coordinates. Must be sorted. With shape (M, k), each column is a different
+        coordinate (e.g., SNP index, BP and CM) with its own max_dist.
+    max_dist : float or array of k floats
         Maximum distance between SNPs included in the same window.
 
     Returns
     -------
-    block_left : 1D np.ndarray with same length as block_left
-        block_left[j] :=  min{k | dist(j, k) < max_dist}.
+    block_left : np.ndarray of ints with same shape as coords
+        block_left[j] :=  min{k | dist(j, k) <= max_dist}.
 
     '''
-    M = len(coords)
-    j = 0
-    block_left = np.zeros(M)
-    for i in range(M):
-        while j < M and abs(coords[j] - coords[i]) > max_dist:
-            j += 1
+    coords = np.asarray(coords)
+    if coords.ndim == 2:
+        max_dist = np.broadcast_to(max_dist, coords.shape[1:])
+        return np.column_stack([getBlockLefts(coords[:, i], max_dist[i])
+                                for i in range(coords.shape[1])])
 
-        block_left[i] = j
-
-    return block_left
+    return np.searchsorted(coords, coords - max_dist, side='left')
 
 
 def block_left_to_right(block_left):
@@ -39,25 +50,150 @@ def block_left_to_right(block_left):
 
     Parameters
     ----------
-    block_left : np.array
-        Array of block lefts.
+    block_left : np.array with shape (M, ) or (M, k)
+        Array of block lefts (one column per window, as returned by getBlockLefts).
+
+    Returns
+    -------
+    block_right : np.ndarray of ints with same shape as block_left
+        block_right[j] := max {k | block_left[k] <= j} + 1
+
+    '''
+    block_left = np.asarray(block_left)
+    if block_left.ndim == 2:
+        return np.column_stack([block_left_to_right(block_left[:, i])
+                                for i in range(block_left.shape[1])])
+
+    return np.searchsorted(block_left, np.arange(len(block_left)), side='right')
+
+
+def decode_bed(packed, n, flip=None, dtype=np.float64):
+    '''
+    Decodes packed plink .bed genotypes into mean-imputed, standardized columns.
+
+    Parameters
+    ----------
+    packed : np.ndarray of uint8 with shape (b, nru/4)
+        Packed genotypes, one row of bytes per SNP (SNP-major mode).
+    n : int
+        Number of individuals (the remaining nru - n genotypes in each row are padding).
+    flip : np.ndarray of bools with shape (b, ), optional
+        SNPs for which the sign of the standardized genotype should be flipped.
+    dtype : np.float64 or np.float32
+        Floating point type of the standardized genotypes.
 
     Returns
     -------
-    block_right : 1D np.ndarray with same length as block_left
-        block_right[j] := max {k | block_left[k] <= j}
+    X : np.ndarray of dtype with shape (n, b)
+        Genotypes normalized to mean zero and variance one, with missing genotypes set
+        to the mean of the non-missing genotypes.
+
+    '''
+    b = packed.shape[0]
+    G = _BED_LOOKUP[packed].reshape((b, -1))[:, 0:n]
+    nonmiss = G != 9
+    n_nonmiss = np.maximum(np.sum(nonmiss, axis=1), 1)
+    avg = (np.sum(np.where(nonmiss, G, 0), axis=1) / n_nonmiss).astype(dtype)
+    X = np.where(nonmiss, G, avg.reshape((b, 1))).T
+    X -= avg
+    denom = np.sqrt(np.mean(np.square(X), axis=0))
+    denom[denom == 0] = 1
+    if flip is not None:
+        denom[flip] *= -1
+
+    X /= denom
+    return X
+
+
+class Checkpoint(object):
+    '''
+    Periodic checkpoints of the progress of __GenotypeArrayInMemory__.ldScoreVarBlocks,
+    so that an interrupted computation can be resumed.
+
+    A checkpoint records the index of the next chunk, the position of the SNP cursor
+    (_currentSNP) at which the window to the left of that chunk starts, and the partial
+    cor_sum, in a .npz file. The file is replaced atomically, so an interruption while
+    writing leaves the previous checkpoint intact.
+
+    Parameters
+    ----------
+    fname : str
+        Checkpoint file name.
+    every : int
+        Number of chunks between checkpoints.
+    key : str
+        Fingerprint of the inputs. A checkpoint made with a different key is not resumed.
+    resume : bool
+        Resume from fname, if it exists?
+
+    Attributes
+    ----------
+    state : dict or None
+        The checkpoint that was resumed, with keys l_B, snp and cor_sum, or None.
+
+    '''
+    def __init__(self, fname, every, key, resume=False):
+        if every < 1:
+            raise ValueError('Checkpoints must be at least 1 chunk apart.')
+
+        self.fname = fname
+        self.every = every
+        self.key = key
+        self.state = None
+        if resume and os.path.exists(fname):
+            with np.load(fname) as x:
+                if str(x['key']) != key:
+                    raise ValueError('Checkpoint {F} was made with different inputs.'.format(F=fname))
+
+                self.state = {'l_B': int(x['l_B']), 'snp': int(x['snp']), 'cor_sum': x['cor_sum']}
 
+    def save(self, l_B, snp, cor_sum):
+        '''Records that all chunks before l_B are done.'''
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'wb') as f:
+            np.savez(f, key=self.key, l_B=l_B, snp=snp, cor_sum=cor_sum)
+
+        os.replace(tmp_fname, self.fname)
+
+    def remove(self):
+        '''Deletes the checkpoint file, e.g., after the computation has finished.'''
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+def _annot_any(annot):
+    '''Does annot (np.ndarray, scipy.sparse matrix or None) have any nonzero entries?'''
+    if sparse.issparse(annot):
+        return annot.count_nonzero() > 0
+
+    return np.any(annot)
+
+
+def _annot_rows(annot, lo, hi):
     '''
-    M = len(block_left)
-    j = 0
-    block_right = np.zeros(M)
-    for i in range(M):
-        while j < M and block_left[j] <= i:
-            j += 1
+    Annotations of SNPs lo, ..., hi-1.
 
-        block_right[i] = j
+    Parameters
+    ----------
+    annot : np.ndarray or scipy.sparse.csr_matrix with shape (M, n_a)
+        SNP annotations.
+    lo, hi : int
+        Range of SNPs.
+
+    Returns
+    -------
+    (cols, x) : tuple
+        x = annot[lo:hi, cols] as a dense array. If annot is dense, cols selects all
+        columns. If annot is sparse, cols are the columns with nonzero entries in rows
+        lo, ..., hi-1, so that products with x only involve these columns.
 
-    return block_right
+    '''
+    if sparse.issparse(annot):
+        x = annot[lo:hi]
+        cols = np.unique(x.indices)
+        return (cols, x[:, cols].toarray())
+
+    return (slice(None), annot[lo:hi, :])
 
 
 class __GenotypeArrayInMemory__(object):
@@ -118,14 +254,73 @@ class __GenotypeArrayInMemory__(object):
     def __filter_snps_maf__(self, geno, m, n, mafMin, keep_snps):
         raise NotImplementedError
 
-    def nextSNPs(self, b, minorRef=None):
+    def nextSNPs(self, b, minorRef=None, dtype=np.float64):
+        raise NotImplementedError
+
+    def __snps__(self, start, b, minorRef=None, dtype=np.float64):
         raise NotImplementedError
 
-    def ldScoreVarBlocks(self, block_left, c, annot=None):
-        '''Computes an unbiased estimate of L2(j) for j=1,..,M.'''
+    def __snp_getter__(self, start, dtype=np.float64):
+        '''
+        Returns a snp_getter that reads SNPs start, start+1, ... without moving
+        _currentSNP, so that several getters can be used at once (e.g., from threads).
+
+        '''
+        pos = start
+
+        def snp_getter(b):
+            nonlocal pos
+            X = self.__snps__(pos, b, dtype=dtype)
+            pos += b
+            return X
+
+        return snp_getter
+
+    def ldScoreVarBlocks(self, block_left, c, annot=None, n_segments=1, dtype=np.float64,
+                         checkpoint=None):
+        '''
+        Computes an unbiased estimate of L2(j) for j=1,..,M. If n_segments > 1, the
+        chromosome is split into n_segments segments that are computed in parallel
+        threads (see __corSumSegments__). If dtype is np.float32, genotypes and
+        correlations are computed in single precision (LD Scores are summed in double
+        precision). If checkpoint (a Checkpoint) is not None, progress is saved
+        periodically, and resumed from checkpoint.state (only if n_segments == 1).
+
+        '''
         func = lambda x: self.__l2_unbiased__(x, self.n)
-        snp_getter = self.nextSNPs
-        return self.__corSumVarBlocks__(block_left, c, func, snp_getter, annot)
+        if n_segments > 1:
+            if checkpoint is not None:
+                raise ValueError('Checkpoints cannot be used with segments.')
+
+            return self.__corSumSegments__(block_left, c, func, annot, n_segments, dtype)
+
+        if checkpoint is not None and checkpoint.state is not None:
+            self._currentSNP = checkpoint.state['snp']
+
+        snp_getter = lambda b: self.nextSNPs(b, dtype=dtype)
+        return self.__corSumVarBlocks__(block_left, c, func, snp_getter, annot, dtype,
+            checkpoint)
+
+    def ldScoreDeviation(self, block_left, c, annot=None, n_snps=1000):
+        '''
+        Computes the LD Scores of about n_snps SNPs in the middle of the chromosome in
+        single and double precision, in order to check the accuracy of single precision.
+
+        Returns
+        -------
+        (s, e, dev) : tuple
+            The sample window is SNPs s, ..., e-1. dev is the maximum absolute difference
+            between the single and double precision LD Scores of these SNPs.
+
+        '''
+        func = lambda x: self.__l2_unbiased__(x, self.n)
+        block_left, block_right, annot = self.__segment_args__(block_left, annot)
+        m = len(block_left)
+        s = c*((m // 2) // c)
+        e = min(s + c*max(n_snps // c, 1), m)
+        x = self.__corSumRange__(s, e, block_left, block_right, c, func, annot, np.float64)
+        y = self.__corSumRange__(s, e, block_left, block_right, c, func, annot, np.float32)
+        return (s, e, np.max(np.abs(x - y)))
 
 
     def __l2_unbiased__(self, x, n):
@@ -134,7 +329,8 @@ class __GenotypeArrayInMemory__(object):
         return sq - (1-sq) / denom
 
     # general methods for calculating sums of Pearson correlation coefficients
-    def __corSumVarBlocks__(self, block_left, c, func, snp_getter, annot=None):
+    def __corSumVarBlocks__(self, block_left, c, func, snp_getter, annot=None,
+                            dtype=np.float64, checkpoint=None):
         '''
         Parameters
         ----------
@@ -153,8 +349,17 @@ class __GenotypeArrayInMemory__(object):
         snp_getter : function(int)
             The method to be used to get the next SNPs (normalized genotypes? Normalized
             genotypes with the minor allele as reference allele? etc)
-        annot: numpy array with shape (m,n_a)
-            SNP annotations.
+        annot: numpy array or scipy.sparse matrix with shape (m,n_a)
+            SNP annotations. Sparse annotations (e.g., many gene sets) are converted to
+            CSR, and each chunk only updates the annotations with nonzero entries in the
+            chunk.
+        dtype : np.float64 or np.float32
+            Floating point type of the genotypes returned by snp_getter and of the
+            correlation matrices. cor_sum is always np.float64.
+        checkpoint : Checkpoint, optional
+            Saves progress every checkpoint.every chunks. If checkpoint.state is not None,
+            the computation resumes at chunk checkpoint.state['l_B'], and snp_getter must
+            return SNPs starting from checkpoint.state['snp'].
 
         Returns
         -------
@@ -162,14 +367,16 @@ class __GenotypeArrayInMemory__(object):
             Estimates.
 
         '''
-        m, n = self.m, self.n
-        block_sizes = np.array(np.arange(m) - block_left)
-        block_sizes = np.ceil(block_sizes / c)*c
-        if not np.any(annot):
+        m, n = len(block_left), self.n
+        block_left = np.asarray(block_left, dtype=int)
+        block_sizes = -(-(np.arange(m) - block_left) // c)*c  # rounded up to multiples of c
+        if sparse.issparse(annot):
+            annot = sparse.csr_matrix(annot)
+        if not _annot_any(annot):
             annot = np.ones((m, 1))
         else:
             annot_m = annot.shape[0]
-            if annot_m != self.m:
+            if annot_m != m:
                 raise ValueError('Incorrect number of SNPs in annot')
 
         n_a = annot.shape[1]  # number of annotations
@@ -180,78 +387,157 @@ class __GenotypeArrayInMemory__(object):
             b = b[0][0]
         else:
             b = m
-        b = int(np.ceil(b/c)*c)  # round up to a multiple of c
+        b = -(-b // c)*c  # round up to a multiple of c
         if b > m:
             c = 1
             b = m
-        l_A = 0  # l_A := index of leftmost SNP in matrix A
-        A = snp_getter(b)
-        rfuncAB = np.zeros((b, c))
-        rfuncBB = np.zeros((c, c))
-        # chunk inside of block
-        for l_B in range(0, b, c):  # l_B := index of leftmost SNP in matrix B
-            B = A[:, l_B:l_B+c]
-            np.dot(A.T, B / n, out=rfuncAB)
-            rfuncAB = func(rfuncAB)
-            cor_sum[l_A:l_A+b, :] += np.dot(rfuncAB, annot[l_B:l_B+c, :])
+        # genotypes are scaled by 1/sqrt(n) as they are read, so that np.dot(A.T, B) is
+        # the correlation matrix. The window [A|B] is kept in W, where A := W[:, w-b:w] are
+        # the b SNPs to the left of the current chunk B := W[:, w:w+c]. W has room for two
+        # windows, so that the window only has to be moved to the front of W occasionally.
+        # rfunc := [A|B].T B is written to the buffer R.
+        max_b = max(b, np.max(block_sizes, initial=0))
+        W = np.empty((n, 2*(max_b+c)), dtype=dtype)
+        R = np.empty((max_b+c)*c, dtype=dtype)
+        scale = W.dtype.type(1 / np.sqrt(n))
+        state = None if checkpoint is None else checkpoint.state
+        if state is None:
+            A = W[:, 0:b]
+            A[...] = snp_getter(b)
+            A *= scale
+            # chunk inside of block
+            rfuncAB = R[0:b*c].reshape((b, c))
+            for l_B in range(0, b, c):  # l_B := index of leftmost SNP in matrix B
+                cols_B, annot_B = _annot_rows(annot, l_B, l_B+c)
+                if np.all(annot_B == 0):
+                    continue
+
+                np.dot(A.T, A[:, l_B:l_B+c], out=rfuncAB)
+                cor_sum[0:b, cols_B] += np.dot(func(rfuncAB), annot_B)
+
+            b0 = b
+            w = b0
+        else:  # resume at chunk b0, reading the window to the left of b0 again
+            if state['cor_sum'].shape != cor_sum.shape:
+                raise ValueError('Checkpoint has the wrong number of SNPs or annotations.')
+
+            cor_sum[...] = state['cor_sum']
+            b0 = state['l_B']
+            w = block_sizes[b0]
+            if w > 0:
+                W[:, 0:w] = snp_getter(w)
+                W[:, 0:w] *= scale
         # chunk to right of block
-        b0 = b
-        md = int(c*np.floor(m/c))
+        md = c*(m // c)
         end = md + 1 if md != m else md
         for l_B in range(b0, end, c):
-            # check if the annot matrix is all zeros for this block + chunk
-            # this happens w/ sparse categories (i.e., pathways)
-            # update the block
-            old_b = b
             b = block_sizes[l_B]
-            if l_B > b0 and b > 0:
-                # block_size can't increase more than c
-                # block_size can't be less than c unless it is zero
-                # both of these things make sense
-                A = np.hstack((A[:, int(old_b-b+c):int(old_b)], B))
-                l_A += int(old_b-b+c)
-            elif l_B == b0 and b > 0:
-                A = A[:, int(b0-b):int(b0)]
-                l_A = int(b0-b)
-            elif b == 0:  # no SNPs to left in window, e.g., after a sequence gap
-                A = np.array(()).reshape((n, 0))
-                l_A = l_B
+            if checkpoint is not None and l_B > b0 and ((l_B-b0) // c) % checkpoint.every == 0:
+                checkpoint.save(l_B, l_B - b, cor_sum)
+
             if l_B == md:
-                c = int(m - md)
-                rfuncAB = np.zeros((int(b), c))
-                rfuncBB = np.zeros((c, c))
-            if b != old_b:
-                rfuncAB = np.zeros((int(b), c))
-
-            B = snp_getter(c)
-            p1 = np.all(annot[l_A:int(l_A+b), :] == 0)
-            p2 = np.all(annot[l_B:int(l_B+c), :] == 0)
+                c = m - md
+            if w + c > W.shape[1]:  # move A to the front of W
+                W[:, 0:b] = W[:, w-b:w]
+                w = b
+
+            l_A = l_B - b  # l_A := index of leftmost SNP in matrix A
+            B = W[:, w:w+c]
+            B[...] = snp_getter(c)
+            B *= scale
+            w += c
+            # check if the annot matrix is all zeros for this block + chunk
+            # this happens w/ sparse categories (i.e., pathways)
+            cols_A, annot_A = _annot_rows(annot, l_A, l_B)
+            cols_B, annot_B = _annot_rows(annot, l_B, l_B+c)
+            p1 = np.all(annot_A == 0)
+            p2 = np.all(annot_B == 0)
             if p1 and p2:
                 continue
 
-            np.dot(A.T, B / n, out=rfuncAB)
-            rfuncAB = func(rfuncAB)
-            cor_sum[l_A:int(l_A+b), :] += np.dot(rfuncAB, annot[l_B:int(l_B+c), :])
-            cor_sum[l_B:int(l_B+c), :] += np.dot(annot[l_A:int(l_A+b), :].T, rfuncAB).T
-            np.dot(B.T, B / n, out=rfuncBB)
-            rfuncBB = func(rfuncBB)
-            cor_sum[l_B:int(l_B+c), :] += np.dot(rfuncBB, annot[l_B:int(l_B+c), :])
+            rfunc = R[0:(b+c)*c].reshape((b+c, c))
+            np.dot(W[:, w-b-c:w-c].T, B, out=rfunc[0:b, :])
+            np.dot(B.T, B, out=rfunc[b:b+c, :])  # B.T B is computed with syrk
+            rfunc = func(rfunc)
+            cor_sum[l_A:l_B+c, cols_B] += np.dot(rfunc, annot_B)
+            cor_sum[l_B:l_B+c, cols_A] += np.dot(rfunc[0:b, :].T, annot_A)
 
         return cor_sum
 
+    def __corSumSegments__(self, block_left, c, func, annot, n_segments, dtype=np.float64):
+        '''
+        Computes the same cor_sum as __corSumVarBlocks__ with the chromosome split into
+        segments of whole chunks, which are computed in parallel threads.
+
+        __corSumVarBlocks__ includes the pair of SNPs i < k iff i >= c*floor(block_left[l]/c),
+        where l is the first SNP in the chunk of k. The rows [s, e) of cor_sum therefore
+        only depend on the SNPs [lo, hi), where lo := c*floor(block_left[s]/c) and hi is the
+        end of the last chunk with block_left < e. Running __corSumVarBlocks__ on SNPs
+        [lo, hi) with block_left shifted by lo gives rows [s, e) exactly. Threads are used
+        rather than processes, since decoding and np.dot release the GIL and the packed
+        genotypes are shared.
+
+        Parameters
+        ----------
+        block_left, c, func, annot, dtype :
+            As for __corSumVarBlocks__.
+        n_segments : int
+            Number of segments (and threads).
+
+        Returns
+        -------
+        cor_sum : np.ndarray with shape (M, num_annots)
+            Estimates.
+
+        '''
+        block_left, block_right, annot = self.__segment_args__(block_left, annot)
+        m = len(block_left)
+        starts = np.unique(c*(np.arange(n_segments)*m // (n_segments*c)))
+        ends = np.append(starts[1:], m)
+
+        def segment(s, e):
+            return self.__corSumRange__(s, e, block_left, block_right, c, func, annot, dtype)
+
+        with ThreadPoolExecutor(max_workers=len(starts)) as executor:
+            cor_sum = list(executor.map(segment, starts, ends))
+
+        return np.vstack(cor_sum)
+
+    def __segment_args__(self, block_left, annot):
+        '''Returns integer block_left and block_right, and annot (ones if annot is None).'''
+        m = len(block_left)
+        if sparse.issparse(annot):
+            annot = sparse.csr_matrix(annot)
+        if not _annot_any(annot):
+            annot = np.ones((m, 1))
+        elif annot.shape[0] != m:
+            raise ValueError('Incorrect number of SNPs in annot')
+
+        block_left = np.asarray(block_left, dtype=int)
+        block_right = block_left_to_right(block_left)
+        return (block_left, block_right, annot)
+
+    def __corSumRange__(self, s, e, block_left, block_right, c, func, annot, dtype):
+        '''Rows s, ..., e-1 of cor_sum, where s and e are multiples of c (or e = M).'''
+        m = len(block_left)
+        lo = c*(block_left[s] // c)
+        hi = min(-(-block_right[e-1] // c)*c, m)
+        annot_seg = annot[lo:hi, :]
+        if not _annot_any(annot_seg):  # cor_sum is zero (and __corSumVarBlocks__ would set annot to 1)
+            return np.zeros((e-s, annot.shape[1]))
+
+        block_left_seg = np.maximum(block_left[lo:hi] - lo, 0)
+        cor_sum = self.__corSumVarBlocks__(block_left_seg, c, func,
+            self.__snp_getter__(lo, dtype), annot_seg, dtype)
+        return cor_sum[s-lo:e-lo, :]
+
 
 class PlinkBEDFile(__GenotypeArrayInMemory__):
     '''
     Interface for Plink .bed format
     '''
     def __init__(self, fname, n, snp_list, keep_snps=None, keep_indivs=None, mafMin=None):
-        self._bedcode = {
-            2: ba.bitarray('11'),
-            9: ba.bitarray('10'),
-            1: ba.bitarray('01'),
-            0: ba.bitarray('00')
-            }
-
+        self._keep_indivs = None
         __GenotypeArrayInMemory__.__init__(self, fname, n, snp_list, keep_snps=keep_snps,
             keep_indivs=keep_indivs, mafMin=mafMin)
 
@@ -259,44 +545,61 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
         if not fname.endswith('.bed'):
             raise ValueError('.bed filename must end in .bed')
 
-        fh = open(fname, 'rb')
-        magicNumber = ba.bitarray(endian="little")
-        magicNumber.fromfile(fh, 2)
-        bedMode = ba.bitarray(endian="little")
-        bedMode.fromfile(fh, 1)
+        with open(fname, 'rb') as fh:
+            magicNumber = fh.read(2)
+            bedMode = fh.read(1)
+
         e = (4 - n % 4) if n % 4 != 0 else 0
         self.nru = n + e
         # check magic number
-        if magicNumber != ba.bitarray('0011011011011000'):
+        if magicNumber != b'\x6c\x1b':
             raise IOError("Magic number from Plink .bed file not recognized")
 
-        if bedMode != ba.bitarray('10000000'):
+        if bedMode != b'\x01':
             raise IOError("Plink .bed file must be in default SNP-major mode")
 
         # check file length
-        self.geno = ba.bitarray(endian="little")
-        self.geno.fromfile(fh)
-        self.__test_length__(self.geno, self.m, self.nru)
+        self.__test_length__(fname, self.m, self.nru)
+        # rows of packed genotypes are read from disk only when they are needed
+        self.geno = np.memmap(fname, dtype=np.uint8, mode='r', offset=3,
+            shape=(self.m, self.nru // 4))
         return (self.nru, self.geno)
 
-    def __test_length__(self, geno, m, nru):
-        exp_len = 2*m*nru
-        real_len = len(geno)
+    def __test_length__(self, fname, m, nru):
+        exp_len = 3 + m*nru // 4
+        real_len = os.path.getsize(fname)
         if real_len != exp_len:
-            s = "Plink .bed file has {n1} bits, expected {n2}"
+            s = "Plink .bed file has {n1} bytes, expected {n2}"
             raise IOError(s.format(n1=real_len, n2=exp_len))
 
     def __filter_indivs__(self, geno, keep_indivs, m, n):
+        '''
+        The packed genotypes are not copied. Individuals are subset lazily, chunk by chunk,
+        by __packed_rows__.
+
+        '''
         n_new = len(keep_indivs)
         e = (4 - n_new % 4) if n_new % 4 != 0 else 0
-        nru_new = n_new + e
-        z = ba.bitarray(m*2*nru_new, endian="little")
-        for e, i in enumerate(keep_indivs):
-            z[2*e::2*nru_new] = geno[2*i::2*self.nru]
-            z[2*e+1::2*nru_new] = geno[2*i+1::2*self.nru]
+        self.nru = n_new + e
+        self._keep_indivs = keep_indivs
+        return (geno, m, n_new)
+
+    def __packed_rows__(self, geno, rows):
+        '''
+        Returns the packed genotypes of SNPs rows for the individuals retained by
+        __filter_indivs__, as a np.ndarray of uint8 with shape (len(rows), nru/4).
+
+        '''
+        z = geno[rows]
+        if self._keep_indivs is None:
+            return z
 
-        self.nru = nru_new
-        return (z, m, n_new)
+        shifts = np.arange(0, 8, 2, dtype=np.uint8)
+        fields = (z.reshape(z.shape + (1,)) >> shifts) & 3
+        y = np.zeros((len(z), self.nru), dtype=np.uint8)
+        y[:, 0:self.n] = fields.reshape((len(z), -1))[:, self._keep_indivs]
+        y = y.reshape((len(z), self.nru // 4, 4)) << shifts
+        return np.bitwise_or.reduce(y, axis=2)
 
     def __filter_snps_maf__(self, geno, m, n, mafMin, keep_snps):
         '''
@@ -304,7 +607,7 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
         Modified from plink_filter.c
         https://github.com/chrchang/plink-ng/blob/master/plink_filter.c
 
-        Genotypes are read forwards (since we are cheating and using endian="little")
+        Genotypes are read forwards (low-order bit of each byte first)
 
         A := (genotype) & 1010...
         B := (genotype) & 0101...
@@ -324,36 +627,32 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
         major allele frequency = (b+c)/(2*(n-a+c))
         het ct + missing ct = a + b - 2*c
 
-        Why does bitarray not have >> ????
+        a, b and c are computed for all SNPs at once by summing per-byte popcounts from a
+        lookup table. The packed genotypes are not copied: SNPs that pass the filters are
+        recorded as row indices into geno.
 
         '''
-        nru = self.nru
-        m_poly = 0
-        y = ba.bitarray()
         if keep_snps is None:
-            keep_snps = range(m)
-        kept_snps = []
-        freq = []
-        for e, j in enumerate(keep_snps):
-            z = geno[2*nru*j:2*nru*(j+1)]
-            A = z[0::2]
-            a = A.count()
-            B = z[1::2]
-            b = B.count()
-            c = (A & B).count()
-            major_ct = b + c  # number of copies of the major allele
-            n_nomiss = n - a + c  # number of individuals with nonmissing genotypes
-            f = major_ct / (2*n_nomiss) if n_nomiss > 0 else 0
-            het_miss_ct = a+b-2*c  # remove SNPs that are only either het or missing
-            if np.minimum(f, 1-f) > mafMin and het_miss_ct < n:
-                freq.append(f)
-                y += z
-                m_poly += 1
-                kept_snps.append(j)
-
-        return (y, m_poly, n, kept_snps, freq)
-
-    def nextSNPs(self, b, minorRef=None):
+            keep_snps = np.arange(m)
+        # zero out the padding at the end of each row (00 adds nothing to a, b or c)
+        pad_mask = np.uint8(0xff >> 2*((4 - n % 4) % 4))
+        counts = np.zeros((len(keep_snps), 3), dtype=np.int64)
+        step = max(_FILTER_CHUNK_BYTES // geno.shape[1], 1)
+        for i in range(0, len(keep_snps), step):
+            z = self.__packed_rows__(geno, keep_snps[i:i+step])
+            z[:, -1] &= pad_mask
+            counts[i:i+step] = np.sum(_BED_POPCOUNT[z], axis=1)
+
+        a, b, c = counts.T
+        major_ct = b + c  # number of copies of the major allele
+        n_nomiss = n - a + c  # number of individuals with nonmissing genotypes
+        f = np.where(n_nomiss > 0, major_ct / (2*np.maximum(n_nomiss, 1)), 0)
+        het_miss_ct = a+b-2*c  # remove SNPs that are only either het or missing
+        ii = (np.minimum(f, 1-f) > mafMin) & (het_miss_ct < n)
+        kept_snps = np.asarray(keep_snps, dtype=int)[ii]
+        return (geno, len(kept_snps), n, kept_snps, f[ii])
+
+    def nextSNPs(self, b, minorRef=None, dtype=np.float64):
         '''
         Unpacks the binary array of genotypes and returns an n x b matrix of floats of
         normalized genotypes for the next b SNPs, where n := number of samples.
@@ -365,10 +664,12 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
         minorRef: bool, default None
             Should we flip reference alleles so that the minor allele is the reference?
             (This is useful for computing l1 w.r.t. minor allele).
+        dtype : np.float64 or np.float32
+            Floating point type of the normalized genotypes.
 
         Returns
         -------
-        X : np.array with dtype float64 with shape (n, b), where n := number of samples
+        X : np.array with dtype dtype with shape (n, b), where n := number of samples
             Matrix of genotypes normalized to mean zero and variance one. If minorRef is
             not None, then the minor allele will be the positive allele (i.e., two copies
             of the minor allele --> a positive number).
@@ -386,26 +687,15 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
             s = '{b} SNPs requested, {k} SNPs remain'
             raise ValueError(s.format(b=b, k=(self.m-self._currentSNP)))
 
-        c = self._currentSNP
-        n = self.n
-        nru = self.nru
-        slice = self.geno[2*c*nru:2*(c+b)*nru]
-        X = np.array(slice.decode(self._bedcode), dtype="float64").reshape((b, nru)).T
-        X = X[0:n, :]
-        Y = np.zeros(X.shape)
-        for j in range(0, b):
-            newsnp = X[:, j]
-            ii = newsnp != 9
-            avg = np.mean(newsnp[ii])
-            newsnp[np.logical_not(ii)] = avg
-            denom = np.std(newsnp)
-            if denom == 0:
-                denom = 1
-
-            if minorRef is not None and self.freq[self._currentSNP + j] > 0.5:
-                denom = denom*-1
-
-            Y[:, j] = (newsnp - avg) / denom
-
+        Y = self.__snps__(self._currentSNP, b, minorRef, dtype)
         self._currentSNP += b
         return Y
+
+    def __snps__(self, start, b, minorRef=None, dtype=np.float64):
+        '''Normalized genotypes of SNPs start, ..., start+b-1 (see nextSNPs).'''
+        packed = self.__packed_rows__(self.geno, self.kept_snps[start:start+b])
+        flip = None
+        if minorRef is not None:
+            flip = np.array(self.freq[start:start+b]) > 0.5
+
+        return decode_bed(packed, self.n, flip, dtype)
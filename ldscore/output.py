@@ -0,0 +1,179 @@
+'''
+This module contains functions for writing compressed output files in-process, without
+writing an uncompressed copy to disk first.
+
+'''
+
+from __future__ import division
+import gzip
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# uncompressed bytes per BGZF block (as in htslib, so that a compressed block always fits
+# in the 64 KB limit)
+_BGZF_BLOCK_SIZE = 65280
+# empty BGZF block that marks the end of a BGZF file
+_BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def _bgzf_block(data, level):
+    '''Compresses data into a single BGZF block (a gzip member with a BC extra field).'''
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                         len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class BGZFWriter(object):
+    '''
+    Binary file object that writes block gzip (BGZF), compressing blocks in parallel threads.
+
+    A BGZF file is a series of gzip members of at most 64 KB, so it can be read by gzip,
+    pandas and anything else that reads .gz files, and also by tabix/htslib. zlib releases
+    the GIL, so blocks are compressed in parallel by a pool of threads and written in order.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    threads : int
+        Number of compression threads.
+    level : int
+        zlib compression level.
+
+    '''
+    def __init__(self, fname, threads=1, level=6):
+        self.fname = fname
+        self.fh = open(fname, 'wb')
+        self.level = level
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= _BGZF_BLOCK_SIZE:
+            self.__submit__(bytes(self.buf[0:_BGZF_BLOCK_SIZE]))
+            del self.buf[0:_BGZF_BLOCK_SIZE]
+
+        return len(data)
+
+    def __submit__(self, data):
+        self.pending.append(self.executor.submit(_bgzf_block, data, self.level))
+        # bound the number of uncompressed blocks held in memory
+        while len(self.pending) > 2*self.threads:
+            self.fh.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.fh.closed:
+            return
+
+        try:
+            if len(self.buf) > 0:
+                self.__submit__(bytes(self.buf))
+                self.buf = bytearray()
+            while self.pending:
+                self.fh.write(self.pending.popleft().result())
+
+            self.fh.write(_BGZF_EOF)
+        finally:
+            self.executor.shutdown()
+            self.fh.close()
+
+    def abort(self):
+        '''
+        Closes and removes the file without writing the EOF block. Every BGZF block is a
+        complete gzip member, so a partial file would otherwise read as a complete one.
+
+        '''
+        if self.fh.closed:
+            return
+
+        try:
+            for f in self.pending:
+                f.cancel()
+            self.executor.shutdown()
+        finally:
+            self.fh.close()
+            os.remove(self.fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class GzipWriter(gzip.GzipFile):
+    '''
+    gzip.GzipFile opened for writing that removes the file if the with block raises, since
+    closing it writes a valid gzip trailer and a partial file would read as complete.
+
+    '''
+    def __init__(self, fname, level=6):
+        self.fname = fname
+        gzip.GzipFile.__init__(self, fname, 'wb', compresslevel=level)
+
+    def abort(self):
+        '''Closes and removes the file.'''
+        try:
+            self.close()
+        finally:
+            os.remove(self.fname)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def open_gzip(fname, threads=None):
+    '''
+    Opens fname for writing gzipped bytes: with gzip if threads is None, else as BGZF with
+    threads compression threads.
+
+    '''
+    if threads is None:
+        return GzipWriter(fname)
+
+    if threads < 1:
+        raise ValueError('Number of compression threads must be >= 1.')
+
+    return BGZFWriter(fname, threads=threads)
+
+
+def write_csv_gz(df, fname, threads=None, chunksize=100000, header=True, **kwargs):
+    '''
+    Writes df.to_csv(fname, **kwargs), gzipped. Rows are formatted chunksize at a time and
+    streamed through the compressor, so neither the uncompressed file nor the full text of
+    df is held on disk or in memory.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data to write.
+    fname : str
+        Output file name (should end in .gz).
+    threads : int, optional
+        If not None, write BGZF with this many compression threads (see open_gzip).
+    chunksize : int
+        Number of rows to format at a time.
+    header : bool
+        Write column names?
+    kwargs :
+        Passed to DataFrame.to_csv (e.g., sep, index, float_format, columns).
+
+    '''
+    with open_gzip(fname, threads) as f:
+        for i in range(0, max(len(df), 1), chunksize):
+            text = df.iloc[i:i+chunksize].to_csv(header=header and i == 0, **kwargs)
+            f.write(text.encode())
@@ -9,6 +9,8 @@ from __future__ import division
 import numpy as np
 import pandas as pd
 import os
+import struct
+import zipfile
 
 
 def series_eq(x, y):
@@ -67,8 +69,15 @@ def read_cts(fh, match_snps):
     return cts.ANNOT.values
 
 
-def sumstats(fh, alleles=False, dropna=True):
-    '''Parses .sumstats files. See docs/file_formats_sumstats.txt.'''
+def sumstats(fh, alleles=False, dropna=True, snps=None):
+    '''
+    Parses .sumstats files. See docs/file_formats_sumstats.txt. Files ending in .npz are
+    read with sumstats_npz. If snps is not None, only rows with SNP in snps are returned.
+
+    '''
+    if fh.endswith('.npz'):
+        return sumstats_npz(fh, alleles=alleles, dropna=dropna, snps=snps)
+
     dtype_dict = {'SNP': str,   'Z': float, 'N': float, 'A1': str, 'A2': str}
     compression = get_compression(fh)
     usecols = ['SNP', 'Z', 'N']
@@ -80,12 +89,106 @@ def sumstats(fh, alleles=False, dropna=True):
     except (AttributeError, ValueError) as e:
         raise ValueError('Improperly formatted sumstats file: ' + str(e.args))
 
+    if snps is not None:
+        x = x[x.SNP.isin(snps)]
     if dropna:
         x = x.dropna(how='any')
 
     return x
 
 
+def npz_memmap(fh):
+    '''
+    Memory-maps the arrays in an uncompressed .npz file (as written by np.savez), so that
+    only the parts of the arrays that are used are read from disk.
+
+    Returns
+    -------
+    arrays : dict
+        Array name (without .npy) -> np.memmap.
+
+    '''
+    arrays = {}
+    with zipfile.ZipFile(fh) as z, open(fh, 'rb') as f:
+        for info in z.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{F} is compressed and cannot be memory-mapped.'.format(F=fh))
+
+            # the array starts after the local file header, which has its own extra field
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            arrays[name] = np.memmap(fh, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                order='F' if fortran_order else 'C')
+
+    return arrays
+
+
+def write_sumstats_npz(fh, df):
+    '''
+    Writes summary statistics to an indexed .sumstats.npz file, which sumstats_npz can read
+    by SNP without reading the whole file. Rows are stored sorted by SNP (the index); the
+    row number of each SNP in df is stored in the array row.
+
+    '''
+    order = np.argsort(df.SNP.values.astype(bytes), kind='stable')
+    arrays = {'row': order}
+    for c in df.columns:
+        x = df[c].values[order]
+        if c in ['SNP', 'A1', 'A2']:
+            x = x.astype(bytes)
+        else:
+            x = x.astype(float)
+        arrays[c] = x
+
+    with open(fh, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def sumstats_npz(fh, alleles=False, dropna=True, snps=None):
+    '''
+    Reads summary statistics written by write_sumstats_npz. Only the columns SNP, Z, N
+    (and A1, A2 if alleles) of the rows with SNP in snps (or all rows, if snps is None)
+    are read. SNPs are looked up by binary search in the sorted SNP index. Rows are
+    returned in the order of the original file.
+
+    '''
+    try:
+        arrays = npz_memmap(fh)
+        usecols = ['SNP', 'Z', 'N']
+        if alleles:
+            usecols += ['A1', 'A2']
+
+        ii = slice(None)
+        if snps is not None:
+            snps = np.unique(np.asarray(snps).astype(bytes))
+            ii = np.minimum(np.searchsorted(arrays['SNP'], snps), len(arrays['SNP']) - 1)
+            ii = ii[arrays['SNP'][ii] == snps]
+            ii = ii[np.argsort(arrays['row'][ii])]
+        else:
+            ii = np.argsort(arrays['row'])
+
+        x = {c: arrays[c][ii] for c in usecols}
+        for c in ['SNP', 'A1', 'A2']:
+            if c in x:
+                x[c] = x[c].astype(str).astype(object)
+        x = pd.DataFrame(x, columns=usecols)
+    except (KeyError, ValueError, zipfile.BadZipFile) as e:
+        raise ValueError('Improperly formatted sumstats file: ' + str(e.args))
+
+    if dropna:  # string columns are never missing
+        x = x.dropna(how='any', subset=['Z', 'N'])
+
+    return x
+
+
 def ldscore_fromlist(flist, num=None):
     '''Sideways concatenation of a list of LD Score files.'''
     ldscore_array = []
@@ -112,6 +215,51 @@ def l2_parser(fh, compression):
     return x
 
 
+def write_columnar(fh, df):
+    '''
+    Writes a DataFrame to an uncompressed .npz file with one typed array per column, which
+    read_columnar reads without parsing text. Floats keep full precision. Object (string)
+    columns are stored as fixed-width unicode.
+
+    '''
+    arrays = {'columns': np.array(df.columns, dtype=str)}
+    for i, c in enumerate(df.columns):
+        x = df[c].values
+        if x.dtype == object:
+            x = x.astype(str)
+        arrays['col' + str(i)] = x
+
+    with open(fh, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def read_columnar(fh):
+    '''Reads a DataFrame written by write_columnar.'''
+    with np.load(fh) as x:
+        columns = list(x['columns'])
+        df = pd.DataFrame({i: x['col' + str(i)] for i in range(len(columns))})
+
+    df.columns = columns
+    return df
+
+
+def l2_filename(fh):
+    '''Full name of an LD Score file, given its name without the .npz/.gz/.bz2 suffix.'''
+    if os.access(fh + '.npz', 4):
+        return fh + '.npz'
+
+    return fh + which_compression(fh)[0]
+
+
+def l2_file(fh):
+    '''Parse an LD Score file, given its name without the .npz/.gz/.bz2 suffix.'''
+    fname = l2_filename(fh)
+    if fname.endswith('.npz'):
+        return read_columnar(fname)
+
+    return l2_parser(fname, get_compression(fname))
+
+
 def annot_parser(fh, compression, frqfile_full=None, compression_frq=None):
     '''Parse annot files'''
     df_annot = read_csv(fh, header=0, compression=compression).drop(['CHR', 'BP', 'CM'], axis=1)
@@ -131,22 +279,45 @@ def frq_parser(fh, compression):
 
 
 def ldscore(fh, num=None):
-    '''Parse .l2.ldscore files, split across num chromosomes. See docs/file_formats_ld.txt.'''
+    '''
+    Parse .l2.ldscore files, split across num chromosomes. See docs/file_formats_ld.txt.
+    Files written by ldsc.py --ldscore-format npz (.l2.ldscore.npz) are read with
+    read_columnar.
+
+    '''
     suffix = '.l2.ldscore'
     if num is not None:  # num files, e.g., one per chromosome
-        first_fh = sub_chr(fh, 1) + suffix
-        s, compression = which_compression(first_fh)
-        chr_ld = [l2_parser(sub_chr(fh, i) + suffix + s, compression) for i in range(1, num + 1)]
+        chr_ld = [l2_file(sub_chr(fh, i) + suffix) for i in range(1, num + 1)]
         x = pd.concat(chr_ld)  # automatically sorted by chromosome
     else:  # just one file
-        s, compression = which_compression(fh + suffix)
-        x = l2_parser(fh + suffix + s, compression)
+        x = l2_file(fh + suffix)
 
     x = x.sort_values(['CHR', 'BP'])  # SEs will be wrong unless sorted
     x = x.drop(['CHR', 'BP'], axis=1).drop_duplicates(subset='SNP')
     return x
 
 
+def ldscore_files(flist, num=None):
+    '''Names of the files read by ldscore_fromlist(flist, num).'''
+    suffix = '.l2.ldscore'
+    if num is None:
+        return [l2_filename(fh + suffix) for fh in flist]
+
+    return [l2_filename(sub_chr(fh, i) + suffix) for fh in flist for i in range(1, num + 1)]
+
+
+def M_files(flist, num=None, N=2, common=False):
+    '''Names of the files read by M_fromlist(flist, num, N, common).'''
+    suffix = '.l' + str(N) + '.M'
+    if common:
+        suffix += '_5_50'
+
+    if num is None:
+        return [fh + suffix for fh in flist]
+
+    return [sub_chr(fh, i) + suffix for fh in flist for i in range(1, num + 1)]
+
+
 def M(fh, num=None, N=2, common=False):
     '''Parses .l{N}.M files, split across num chromosomes. See docs/file_formats_ld.txt.'''
 
@@ -269,7 +440,7 @@ def __ID_List_Factory__(colnames, keepcol, fname_end, header=None, usecols=None)
             z = pd.merge(self.IDList, merge_df, how='left', left_on=l, right_on=r,
                          sort=False)
             ii = z['keep'] == True
-            return np.nonzero(ii)[0]
+            return np.nonzero(ii.values)[0]
 
     return IDContainer
 
@@ -71,6 +71,54 @@ def remove_intercept(x):
     return x[:, 0:n_col - 1]
 
 
+class LazyDesign(object):
+
+    '''
+    Design matrix of LD Score regression, np.multiply(N, x) / Nbar, optionally with an
+    intercept column appended, computed from x only for the rows that are sliced. The block
+    jackknife and IRWLS read the design a chunk of rows at a time, so a regression never
+    holds a full-length copy of the design, and x can be a np.memmap.
+
+    Parameters
+    ----------
+    x : np.ndarray or np.memmap with shape (n_snp, n_annot)
+        LD Scores.
+    N : np.ndarray with shape (n_snp, 1)
+        Sample sizes.
+    Nbar : float
+        Mean sample size.
+    intercept : bool
+        Append an intercept column?
+    index : np.ndarray of ints, optional
+        Rows of x to use (e.g., the SNPs in step 1 of the two-step estimator).
+
+    '''
+
+    def __init__(self, x, N, Nbar, intercept=False, index=None):
+        self.x, self.N, self.Nbar = x, N, Nbar
+        self.intercept, self.index = intercept, index
+        n_row = x.shape[0] if index is None else len(index)
+        self.shape = (n_row, x.shape[1] + int(intercept))
+
+    def __getitem__(self, key):
+        cols = slice(None)
+        if isinstance(key, tuple):
+            key, cols = key
+        if self.index is not None:
+            key = self.index[key]
+
+        x_new = np.multiply(self.N[key], self.x[key]) / self.Nbar
+        if self.intercept:
+            x_new = np.concatenate((x_new, np.ones(x_new.shape[:-1] + (1,))), axis=-1)
+        if cols is Ellipsis:
+            return x_new
+
+        return x_new[..., cols]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
 def gencov_obs_to_liab(gencov_obs, P1, P2, K1, K2):
     '''
     Converts genetic covariance on the observed scale in an ascertained sample to genetic
@@ -138,7 +186,8 @@ def h2_obs_to_liab(h2_obs, P, K):
 
 class LD_Score_Regression(object):
 
-    def __init__(self, y, x, w, N, M, n_blocks, intercept=None, slow=False, step1_ii=None, old_weights=False):
+    def __init__(self, y, x, w, N, M, n_blocks, intercept=None, slow=False, step1_ii=None, old_weights=False,
+                 irwls_tol=None, irwls_max_iter=2):
         for i in [y, x, w, M, N]:
             try:
                 if len(i.shape) != 2:
@@ -161,9 +210,10 @@ class LD_Score_Regression(object):
         initial_w = self._update_weights(
             x_tot, w, N, M_tot, tot_agg, intercept)
         Nbar = np.mean(N)  # keep condition number low
-        x = np.multiply(N, x) / Nbar
+        ld = x
+        x = LazyDesign(ld, N, Nbar, intercept=not self.constrain_intercept)
         if not self.constrain_intercept:
-            x, x_tot = append_intercept(x), append_intercept(x_tot)
+            x_tot = append_intercept(x_tot)
             yp = y
         else:
             yp = y - intercept
@@ -180,36 +230,42 @@ class LD_Score_Regression(object):
         elif step1_ii is not None:
             n1 = np.sum(step1_ii)
             self.twostep_filtered = n_snp - n1
-            x1 = x[np.squeeze(step1_ii), :]
+            x1 = LazyDesign(ld, N, Nbar, intercept=True,
+                            index=np.flatnonzero(step1_ii))
             yp1, w1, N1, initial_w1 = map(
                 lambda a: a[step1_ii].reshape((n1, 1)), (yp, w, N, initial_w))
             update_func1 = lambda a: self._update_func(
                 a, x1, w1, N1, M_tot, Nbar, ii=step1_ii)
             step1_jknife = IRWLS(
-                x1, yp1, update_func1, n_blocks, slow=slow, w=initial_w1)
+                x1, yp1, update_func1, n_blocks, slow=slow, w=initial_w1, tol=irwls_tol,
+                max_iter=irwls_max_iter)
             step1_int, _ = self._intercept(step1_jknife)
             yp = yp - step1_int
-            x = remove_intercept(x)
+            x = LazyDesign(ld, N, Nbar)
             x_tot = remove_intercept(x_tot)
             update_func2 = lambda a: self._update_func(
                 a, x_tot, w, N, M_tot, Nbar, step1_int)
             s = update_separators(step1_jknife.separators, step1_ii)
             step2_jknife = IRWLS(
-                x, yp, update_func2, n_blocks, slow=slow, w=initial_w, separators=s)
+                x, yp, update_func2, n_blocks, slow=slow, w=initial_w, separators=s,
+                tol=irwls_tol, max_iter=irwls_max_iter)
+            self.n_iter = step1_jknife.n_iter + step2_jknife.n_iter
+            x = np.asarray(x)  # n_annot == 1
             c = np.sum(np.multiply(initial_w, x)) / \
                 np.sum(np.multiply(initial_w, np.square(x)))
             jknife = self._combine_twostep_jknives(
                 step1_jknife, step2_jknife, M_tot, c, Nbar)
         elif old_weights:
-            initial_w = np.sqrt(initial_w)
-            x = IRWLS._weight(x, initial_w)
-            y = IRWLS._weight(yp, initial_w)
-            jknife = jk.LstsqJackknifeFast(x, y, n_blocks)
+            initial_w = IRWLS._normalize(np.sqrt(initial_w))
+            jknife = jk.LstsqJackknifeFast(x, yp, n_blocks, w=initial_w)
+            self.n_iter = 0
         else:
             update_func = lambda a: self._update_func(
                 a, x_tot, w, N, M_tot, Nbar, intercept)
             jknife = IRWLS(
-                x, yp, update_func, n_blocks, slow=slow, w=initial_w)
+                x, yp, update_func, n_blocks, slow=slow, w=initial_w, tol=irwls_tol,
+                max_iter=irwls_max_iter)
+            self.n_iter = jknife.n_iter
 
         self.coef, self.coef_cov, self.coef_se = self._coef(jknife, Nbar)
         self.cat, self.cat_cov, self.cat_se =\
@@ -330,13 +386,15 @@ class Hsq(LD_Score_Regression):
 
     __null_intercept__ = 1
 
-    def __init__(self, y, x, w, N, M, n_blocks=200, intercept=None, slow=False, twostep=None, old_weights=False):
+    def __init__(self, y, x, w, N, M, n_blocks=200, intercept=None, slow=False, twostep=None, old_weights=False,
+                 irwls_tol=None, irwls_max_iter=2):
         step1_ii = None
         if twostep is not None:
             step1_ii = y < twostep
 
         LD_Score_Regression.__init__(self, y=y, x=x, w=w, N=N, M=M, n_blocks=n_blocks, intercept=intercept,
-                                     slow=slow, step1_ii=step1_ii, old_weights=old_weights)
+                                     slow=slow, step1_ii=step1_ii, old_weights=old_weights,
+                                     irwls_tol=irwls_tol, irwls_max_iter=irwls_max_iter)
         self.mean_chisq, self.lambda_gc = self._summarize_chisq(y)
         if not self.constrain_intercept:
             self.ratio, self.ratio_se = self._ratio(
@@ -518,7 +576,8 @@ class Gencov(LD_Score_Regression):
     __null_intercept__ = 0
 
     def __init__(self, z1, z2, x, w, N1, N2, M, hsq1, hsq2, intercept_hsq1, intercept_hsq2,
-                 n_blocks=200, intercept_gencov=None, slow=False, twostep=None):
+                 n_blocks=200, intercept_gencov=None, slow=False, twostep=None, irwls_tol=None,
+                 irwls_max_iter=2):
         self.intercept_hsq1 = intercept_hsq1
         self.intercept_hsq2 = intercept_hsq2
         self.hsq1 = hsq1
@@ -531,7 +590,8 @@ class Gencov(LD_Score_Regression):
             step1_ii = np.logical_and(z1**2 < twostep, z2**2 < twostep)
 
         LD_Score_Regression.__init__(self, y, x, w, np.sqrt(N1 * N2), M, n_blocks,
-                                     intercept=intercept_gencov, slow=slow, step1_ii=step1_ii)
+                                     intercept=intercept_gencov, slow=slow, step1_ii=step1_ii,
+                                     irwls_tol=irwls_tol, irwls_max_iter=irwls_max_iter)
         self.p, self.z = p_z_norm(self.tot, self.tot_se)
         self.mean_z1z2 = np.mean(np.multiply(z1, z2))
 
@@ -659,17 +719,24 @@ class Gencov(LD_Score_Regression):
 class RG(object):
 
     def __init__(self, z1, z2, x, w, N1, N2, M, intercept_hsq1=None, intercept_hsq2=None,
-                 intercept_gencov=None, n_blocks=200, slow=False, twostep=None):
+                 intercept_gencov=None, n_blocks=200, slow=False, twostep=None, hsq1=None,
+                 hsq2=None, irwls_tol=None, irwls_max_iter=2):
 
         self._negative_hsq = None
         n_snp, n_annot = x.shape
-        hsq1 = Hsq(np.square(z1), x, w, N1, M, n_blocks=n_blocks, intercept=intercept_hsq1,
-                   slow=slow, twostep=twostep)
-        hsq2 = Hsq(np.square(z2), x, w, N2, M, n_blocks=n_blocks, intercept=intercept_hsq2,
-                   slow=slow, twostep=twostep)
+        # hsq1 and hsq2 may be passed in if they were already estimated from the same SNPs
+        # and jackknife blocks, e.g., when estimating rg between all pairs of many traits
+        if hsq1 is None:
+            hsq1 = Hsq(np.square(z1), x, w, N1, M, n_blocks=n_blocks, intercept=intercept_hsq1,
+                       slow=slow, twostep=twostep, irwls_tol=irwls_tol,
+                       irwls_max_iter=irwls_max_iter)
+        if hsq2 is None:
+            hsq2 = Hsq(np.square(z2), x, w, N2, M, n_blocks=n_blocks, intercept=intercept_hsq2,
+                       slow=slow, twostep=twostep, irwls_tol=irwls_tol,
+                       irwls_max_iter=irwls_max_iter)
         gencov = Gencov(z1, z2, x, w, N1, N2, M, hsq1.tot, hsq2.tot, hsq1.intercept,
                         hsq2.intercept, n_blocks, intercept_gencov=intercept_gencov, slow=slow,
-                        twostep=twostep)
+                        twostep=twostep, irwls_tol=irwls_tol, irwls_max_iter=irwls_max_iter)
         gencov.N1 = None  # save memory
         gencov.N2 = None
         self.hsq1, self.hsq2, self.gencov = hsq1, hsq2, gencov
@@ -9,40 +9,20 @@ regression is implemented in the regressions module.
 from __future__ import division
 import numpy as np
 import pandas as pd
-import itertools as it
 import ldscore.parse as ps
 import ldscore.regressions as reg
+import ldscore.alleles as al
+from ldscore.cache import RefCache
 import sys
 import traceback
 import copy
+import tempfile
+from multiprocessing import Pool
 
 _N_CHR = 22
-# complementary bases
-COMPLEMENT = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-# bases
-BASES = COMPLEMENT.keys()
-# true iff strand ambiguous
-STRAND_AMBIGUOUS = {''.join(x): x[0] == COMPLEMENT[x[1]]
-                    for x in it.product(BASES, BASES)
-                    if x[0] != x[1]}
-# SNPS we want to keep (pairs of alleles)
-VALID_SNPS = {x for x in map(lambda y: ''.join(y), it.product(BASES, BASES))
-              if x[0] != x[1] and not STRAND_AMBIGUOUS[x]}
-# T iff SNP 1 has the same alleles as SNP 2 (allowing for strand or ref allele flip).
-MATCH_ALLELES = {x for x in map(lambda y: ''.join(y), it.product(VALID_SNPS, VALID_SNPS))
-                 # strand and ref match
-                 if ((x[0] == x[2]) and (x[1] == x[3])) or
-                 # ref match, strand flip
-                 ((x[0] == COMPLEMENT[x[2]]) and (x[1] == COMPLEMENT[x[3]])) or
-                 # ref flip, strand match
-                 ((x[0] == x[3]) and (x[1] == x[2])) or
-                 ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]]))}  # strand and ref flip
-# T iff SNP 1 has the same alleles as SNP 2 w/ ref allele flip.
-FLIP_ALLELES = {''.join(x):
-                ((x[0] == x[3]) and (x[1] == x[2])) or  # strand match
-                # strand flip
-                ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]]))
-                for x in MATCH_ALLELES}
+# allele sets, here for backwards compatibility (see ldscore.alleles)
+from ldscore.alleles import (COMPLEMENT, BASES, STRAND_AMBIGUOUS, VALID_SNPS, MATCH_ALLELES,
+                             FLIP_ALLELES)
 
 
 def _select_and_log(x, ii, log, msg):
@@ -68,10 +48,23 @@ def smart_merge(x, y):
     return out
 
 
+def _ref_cache(args):
+    '''Cache of parsed reference files (--ld-cache), or None.'''
+    if args.ld_cache is None:
+        return None
+
+    max_size = None
+    if args.ld_cache_size is not None:
+        max_size = args.ld_cache_size*1024**3
+
+    return RefCache(args.ld_cache, max_size)
+
+
 def _read_ref_ld(args, log):
     '''Read reference LD Scores.'''
     ref_ld = _read_chr_split_files(args.ref_ld_chr, args.ref_ld, log,
-                                   'reference panel LD Score', ps.ldscore_fromlist)
+                                   'reference panel LD Score', ps.ldscore_fromlist,
+                                   cache=_ref_cache(args), filesfunc=ps.ldscore_files)
     log.log(
         'Read reference panel LD Scores for {N} SNPs.'.format(N=len(ref_ld)))
     return ref_ld
@@ -103,11 +96,17 @@ def _read_M(args, n_annot):
             raise ValueError('Could not cast --M to float: ' + str(e.args))
     else:
         if args.ref_ld:
-            M_annot = ps.M_fromlist(
-                args.ref_ld.split(','), common=(not args.not_M_5_50))
+            flist, num = args.ref_ld.split(','), None
         elif args.ref_ld_chr:
-            M_annot = ps.M_fromlist(
-                args.ref_ld_chr.split(','), _N_CHR, common=(not args.not_M_5_50))
+            flist, num = args.ref_ld_chr.split(','), _N_CHR
+
+        common = not args.not_M_5_50
+        cache = _ref_cache(args)
+        if cache is None:
+            M_annot = ps.M_fromlist(flist, num, common=common)
+        else:
+            M_annot, _ = cache.get('M_fromlist', ps.M_files(flist, num, common=common),
+                                   lambda: ps.M_fromlist(flist, num, common=common))
 
     try:
         M_annot = np.array(M_annot).reshape((1, n_annot))
@@ -124,7 +123,8 @@ def _read_w_ld(args, log):
         raise ValueError(
             '--w-ld must point to a single fileset (no commas allowed).')
     w_ld = _read_chr_split_files(args.w_ld_chr, args.w_ld, log,
-                                 'regression weight LD Score', ps.ldscore_fromlist)
+                                 'regression weight LD Score', ps.ldscore_fromlist,
+                                 cache=_ref_cache(args), filesfunc=ps.ldscore_files)
     if len(w_ld.columns) != 2:
         raise ValueError('--w-ld may only have one LD Score column.')
     w_ld.columns = ['SNP', 'LD_weights']  # prevent colname conflicts w/ ref ld
@@ -133,16 +133,30 @@ def _read_w_ld(args, log):
     return w_ld
 
 
-def _read_chr_split_files(chr_arg, not_chr_arg, log, noun, parsefunc, **kwargs):
-    '''Read files split across 22 chromosomes (annot, ref_ld, w_ld).'''
+def _read_chr_split_files(chr_arg, not_chr_arg, log, noun, parsefunc, cache=None,
+                          filesfunc=None, **kwargs):
+    '''
+    Read files split across 22 chromosomes (annot, ref_ld, w_ld). If cache is not None,
+    the parsed output is read from or saved to cache, keyed on filesfunc(flist, num), the
+    names of the files read by parsefunc(flist, num).
+
+    '''
     try:
         if not_chr_arg:
             log.log('Reading {N} from {F} ...'.format(F=not_chr_arg, N=noun))
-            out = parsefunc(not_chr_arg.split(','), **kwargs)
+            flist, num = not_chr_arg.split(','), None
         elif chr_arg:
             f = ps.sub_chr(chr_arg, '[1-22]')
             log.log('Reading {N} from {F} ...'.format(F=f, N=noun))
-            out = parsefunc(chr_arg.split(','), _N_CHR, **kwargs)
+            flist, num = chr_arg.split(','), _N_CHR
+
+        if cache is None:
+            out = parsefunc(flist, num, **kwargs)
+        else:
+            out, hit = cache.get(parsefunc.__name__, filesfunc(flist, num),
+                                 lambda: parsefunc(flist, num, **kwargs))
+            if hit:
+                log.log('Read {N} from cache in {D}.'.format(N=noun, D=cache.cache_dir))
     except ValueError as e:
         log.log('Error parsing {N}.'.format(N=noun))
         raise e
@@ -150,11 +164,13 @@ def _read_chr_split_files(chr_arg, not_chr_arg, log, noun, parsefunc, **kwargs):
     return out
 
 
-def _read_sumstats(args, log, fh, alleles=False, dropna=False):
-    '''Parse summary statistics.'''
+def _read_sumstats(args, log, fh, alleles=False, dropna=False, snps=None):
+    '''Parse summary statistics (only for SNPs in snps, if snps is not None).'''
     log.log('Reading summary statistics from {S} ...'.format(S=fh))
-    sumstats = ps.sumstats(fh, alleles=alleles, dropna=dropna)
+    sumstats = ps.sumstats(fh, alleles=alleles, dropna=dropna, snps=snps)
     log_msg = 'Read summary statistics for {N} SNPs.'
+    if snps is not None:
+        log_msg = 'Read summary statistics for {N} SNPs in the reference panel.'
     log.log(log_msg.format(N=len(sumstats)))
     m = len(sumstats)
     sumstats = sumstats.drop_duplicates(subset='SNP')
@@ -240,6 +256,21 @@ def _read_ld_sumstats(args, log, fh, alleles=False, dropna=True, sumstats=pd.Dat
     return M_annot, w_ld_cname, ref_ld_cnames, sumstats, novar_cols
 
 
+def _read_ref(args, log):
+    '''
+    Read M and the reference panel LD Scores merged with the regression weight LD Scores
+    (column LD_weights), for running many regressions against one reference.
+
+    '''
+    ref_ld = _read_ref_ld(args, log)
+    n_annot = len(ref_ld.columns) - 1
+    M_annot = _read_M(args, n_annot)
+    M_annot, ref_ld, novar_cols = _check_variance(log, M_annot, ref_ld)
+    w_ld = _read_w_ld(args, log)
+    ref = _merge_and_log(ref_ld, w_ld, 'regression SNP LD', log)
+    return M_annot, ref, ref_ld.columns[1:len(ref_ld.columns)]
+
+
 def estimate_h2(args, log, sumstats=pd.DataFrame()):
     '''Estimate h2 and partitioned h2.'''
     args = copy.deepcopy(args)
@@ -252,6 +283,17 @@ def estimate_h2(args, log, sumstats=pd.DataFrame()):
         args.intercept_h2 = 1
     M_annot, w_ld_cname, ref_ld_cnames, sumstats, novar_cols = _read_ld_sumstats(
         args, log, args.h2, sumstats=sumstats)
+    return _h2(args, log, sumstats, M_annot, ref_ld_cnames, w_ld_cname, args.out,
+               args.samp_prev, args.pop_prev)
+
+
+def _h2(args, log, sumstats, M_annot, ref_ld_cnames, w_ld_cname, out, P, K,
+        overlap=None):
+    '''
+    Run the h2 regression on sumstats merged with the reference panel and regression
+    weight LD Scores, writing optional outputs to out.[cov/delete/results].
+
+    '''
     ref_ld = np.array(sumstats[ref_ld_cnames])
     _check_ld_condnum(args, log, ref_ld_cnames)
     _warn_length(log, sumstats)
@@ -284,25 +326,183 @@ def estimate_h2(args, log, sumstats=pd.DataFrame()):
 
     hsqhat = reg.Hsq(chisq, ref_ld, s(sumstats[w_ld_cname]), s(sumstats.N),
                      M_annot, n_blocks=n_blocks, intercept=args.intercept_h2,
-                     twostep=args.two_step, old_weights=old_weights)
+                     twostep=args.two_step, old_weights=old_weights,
+                     irwls_tol=args.irwls_tol, irwls_max_iter=args.irwls_max_iter)
+    if args.irwls_tol is not None:
+        log.log('IRWLS stopped after {N} reweighting passes.'.format(N=hsqhat.n_iter))
 
     if args.print_cov:
-        _print_cov(hsqhat, args.out + '.cov', log)
+        _print_cov(hsqhat, out + '.cov', log)
     if args.print_delete_vals:
-        _print_delete_values(hsqhat, args.out + '.delete', log)
+        _print_delete_values(hsqhat, out + '.delete', log)
 
-    log.log(hsqhat.summary(ref_ld_cnames, P=args.samp_prev, K=args.pop_prev))
+    log.log(hsqhat.summary(ref_ld_cnames, P=P, K=K))
     if args.overlap_annot:
-        overlap_matrix, M_tot = _read_annot(args, log)
+        if overlap is None:
+            overlap = _read_annot(args, log)
+        overlap_matrix, M_tot = overlap
 
         # overlap_matrix = overlap_matrix[np.array(~novar_cols), np.array(~novar_cols)]#np.logical_not
         df_results = hsqhat._overlap_output(ref_ld_cnames, overlap_matrix, M_annot, M_tot, args.print_coefficients)
-        df_results.to_csv(args.out+'.results', sep="\t", index=False)
-        log.log('Results printed to '+args.out+'.results')
+        df_results.to_csv(out+'.results', sep="\t", index=False)
+        log.log('Results printed to '+out+'.results')
 
     return hsqhat
 
 
+class _LogBuffer(object):
+    '''Collects the log messages of a worker process, for the main process to log.'''
+
+    def __init__(self):
+        self.msgs = []
+
+    def log(self, msg):
+        self.msgs.append(str(msg))
+
+
+# reference data shared by the h2 worker processes, set by _h2_worker_init
+_H2_REF = {}
+
+
+def _h2_worker_init(args, ref, M_annot, ref_ld_cnames, w_ld_cname, overlap):
+    _H2_REF.update(args=args, ref=ref, M_annot=M_annot, ref_ld_cnames=ref_ld_cnames,
+                   w_ld_cname=w_ld_cname, overlap=overlap)
+
+
+def _h2_worker(job):
+    '''
+    Estimate h2 for one trait of estimate_h2_batch. Returns the log messages and a row of
+    the results table. Errors are logged and leave the estimates in the row missing.
+
+    '''
+    i, fh, out, P, K = job
+    log = _LogBuffer()
+    args = copy.deepcopy(_H2_REF['args'])
+    row = {'trait': fh}
+    try:
+        sumstats = _read_sumstats(args, log, fh, dropna=True)
+        sumstats = _merge_and_log(_H2_REF['ref'], sumstats, 'reference panel LD', log)
+        hsqhat = _h2(args, log, sumstats, _H2_REF['M_annot'], _H2_REF['ref_ld_cnames'],
+                     _H2_REF['w_ld_cname'], out, P, K, overlap=_H2_REF['overlap'])
+        row.update(_h2_row(hsqhat, len(sumstats), P, K))
+    except Exception:  # keep going if trait 50/4000 causes an error
+        log.log('ERROR computing h2 for trait {I}, from file {F}.'.format(I=i + 1, F=fh))
+        log.log(traceback.format_exc())
+
+    return log.msgs, row
+
+
+def _h2_row(hsqhat, n_snp, P, K):
+    '''Row of the batch h2 results table.'''
+    row = {'n_snp': n_snp, 'h2_obs': hsqhat.tot, 'h2_obs_se': hsqhat.tot_se}
+    if P is not None and K is not None:
+        c = reg.h2_obs_to_liab(1, P, K)
+        row.update(h2_liab=c*hsqhat.tot, h2_liab_se=c*hsqhat.tot_se)
+
+    row.update(lambda_gc=hsqhat.lambda_gc, mean_chisq=hsqhat.mean_chisq,
+               intercept=hsqhat.intercept, intercept_se=getattr(hsqhat, 'intercept_se', None))
+    if hasattr(hsqhat, 'ratio'):
+        row.update(ratio=hsqhat.ratio, ratio_se=hsqhat.ratio_se)
+
+    return row
+
+
+def _h2_paths(args):
+    '''List of sumstats files from --h2 (comma-separated) or --h2-manifest (one per line).'''
+    if args.h2_manifest is not None:
+        with open(args.h2_manifest) as f:
+            paths = [x.strip() for x in f if x.strip() and not x.startswith('#')]
+    else:
+        paths = args.h2.split(',')
+
+    if len(paths) == 0:
+        raise ValueError('No summary statistics files in --h2-manifest.')
+
+    return paths
+
+
+def _per_trait_arg(x, n, flag):
+    '''Parse a comma-separated list with one value per trait, or one value for all traits.'''
+    y = _split_or_none(x, n)
+    if len(y) == 1:
+        y = y*n
+
+    _check_arg_len((y, flag), n)
+    return y
+
+
+def estimate_h2_batch(args, log):
+    '''
+    Estimate h2 for many traits (--h2 with a comma-separated list, or --h2-manifest).
+    The reference panel LD Scores, regression weight LD Scores and M are read and merged
+    once, and the regressions for the traits are run in args.n_jobs worker processes. The
+    log of each trait is printed in order, outputs for each trait are written to
+    args.out.[trait file name].*, and a table with one row per trait is written to
+    args.out.h2.results. If a trait causes an error, it is logged and its row is left
+    blank.
+
+    '''
+    args = copy.deepcopy(args)
+    h2_paths = _h2_paths(args)
+    n_trait = len(h2_paths)
+    samp_prev = _per_trait_arg(args.samp_prev, n_trait, '--samp-prev')
+    pop_prev = _per_trait_arg(args.pop_prev, n_trait, '--pop-prev')
+    if args.intercept_h2 is not None:
+        args.intercept_h2 = float(args.intercept_h2)
+    if args.no_intercept:
+        args.intercept_h2 = 1
+
+    M_annot, ref, ref_ld_cnames = _read_ref(args, log)
+    overlap = None
+    if args.overlap_annot:
+        overlap = _read_annot(args, log)
+
+    names = [x.split('/')[-1] for x in h2_paths]
+    if len(set(names)) < n_trait:  # keep output file names unique
+        names = [str(i + 1) + '_' + x for i, x in enumerate(names)]
+
+    jobs = [(i, h2_paths[i], args.out + '.' + names[i], samp_prev[i], pop_prev[i])
+            for i in range(n_trait)]
+    initargs = (args, ref, M_annot, ref_ld_cnames, 'LD_weights', overlap)
+    n_jobs = min(args.n_jobs, n_trait)
+    log.log('Estimating h2 for {N} traits with {J} worker processes.'.format(N=n_trait,
+                                                                              J=n_jobs))
+    pool = None
+    if n_jobs > 1:
+        pool = Pool(n_jobs, initializer=_h2_worker_init, initargs=initargs)
+        results = pool.imap(_h2_worker, jobs)
+    else:
+        _h2_worker_init(*initargs)
+        results = map(_h2_worker, jobs)
+
+    rows = []
+    try:
+        l = lambda x: x + ''.join(['-' for i in range(len(x.replace('\n', '')))])
+        for i, (msgs, row) in enumerate(results):
+            log.log(l('\nHeritability of trait {I}/{N}\n'.format(I=i + 1, N=n_trait)))
+            log.log('\n'.join(msgs))
+            rows.append(row)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    x = pd.DataFrame(rows, columns=_h2_table_columns(rows))
+    x['n_snp'] = [int(n) if not pd.isnull(n) else 'NA' for n in x.n_snp]
+    out_fh = args.out + '.h2.results'
+    x.to_csv(out_fh, sep='\t', index=False, na_rep='NA')
+    log.log('\nSummary of Heritability Results\n' +
+            x.to_string(header=True, index=False, na_rep='NA') + '\n')
+    log.log('Results printed to ' + out_fh)
+    return x
+
+
+def _h2_table_columns(rows):
+    '''Columns of the batch h2 results table, in order, for the fields present in rows.'''
+    columns = ['trait', 'n_snp', 'h2_obs', 'h2_obs_se', 'h2_liab', 'h2_liab_se', 'lambda_gc',
+               'mean_chisq', 'intercept', 'intercept_se', 'ratio', 'ratio_se']
+    return [c for c in columns if any(c in row for row in rows)]
+
+
 def estimate_rg(args, log):
     '''Estimate rg between trait 1 and a list of other traits.'''
     args = copy.deepcopy(args)
@@ -318,10 +518,11 @@ def estimate_rg(args, log):
     if args.no_intercept:
         args.intercept_h2 = [1 for _ in range(n_pheno)]
         args.intercept_gencov = [0 for _ in range(n_pheno)]
-    p1 = rg_paths[0]
     out_prefix = args.out + rg_files[0]
-    M_annot, w_ld_cname, ref_ld_cnames, sumstats, _ = _read_ld_sumstats(args, log, p1,
-                                                                        alleles=True, dropna=True)
+    M_annot, ref, ref_ld_cnames = _read_ref(args, log)
+    z, N, ok = _align_sumstats(args, log, rg_paths, ref)
+    ref_ld = np.array(ref[ref_ld_cnames])
+    w = np.array(ref.LD_weights)
     RG = []
     n_annot = M_annot.shape[1]
     if n_annot == 1 and args.two_step is None and args.intercept_h2 is None:
@@ -330,11 +531,19 @@ def estimate_rg(args, log):
         log.log('Using two-step estimator with cutoff at {M}.'.format(M=args.two_step))
 
     for i, p2 in enumerate(rg_paths[1:n_pheno]):
+        if i + 1 not in ok:  # error reading the summary statistics, already logged
+            RG.append(None)
+            continue
+
         log.log(
             'Computing rg for phenotype {I}/{N}'.format(I=i + 2, N=len(rg_paths)))
         try:
-            loop = _read_other_sumstats(args, log, p2, sumstats, ref_ld_cnames)
-            rghat = _rg(loop, args, log, M_annot, ref_ld_cnames, w_ld_cname, i)
+            ii = ~np.isnan(z[:, 0]) & ~np.isnan(z[:, i + 1])
+            _select_and_log(ii, ii, log, '{N} SNPs shared with phenotype 1.')
+            _check_ld_condnum(args, log, ref_ld[ii])
+            _warn_length(log, ref_ld[ii])
+            rghat = _rg(args, z[ii, 0], z[ii, i + 1], ref_ld[ii], w[ii], N[ii, 0], N[ii, i + 1],
+                        M_annot, i)
             RG.append(rghat)
             _print_gencor(args, log, rghat, ref_ld_cnames, i, rg_paths, i == 0)
             out_prefix_loop = out_prefix + '_' + rg_files[i + 1]
@@ -346,8 +555,7 @@ def estimate_rg(args, log):
         except Exception:  # keep going if phenotype 50/100 causes an error
             msg = 'ERROR computing rg for phenotype {I}/{N}, from file {F}.'
             log.log(msg.format(I=i + 2, N=len(rg_paths), F=rg_paths[i + 1]))
-            ex_type, ex, tb = sys.exc_info()
-            log.log(traceback.format_exc(ex) + '\n')
+            log.log(traceback.format_exc() + '\n')
             if len(RG) <= i:  # if exception raised before appending to RG
                 RG.append(None)
 
@@ -356,20 +564,209 @@ def estimate_rg(args, log):
     return RG
 
 
-def _read_other_sumstats(args, log, p2, sumstats, ref_ld_cnames):
-    loop = _read_sumstats(args, log, p2, alleles=True, dropna=False)
-    loop = _merge_sumstats_sumstats(args, sumstats, loop, log)
-    loop = loop.dropna(how='any')
-    alleles = loop.A1 + loop.A2 + loop.A1x + loop.A2x
-    if not args.no_check_alleles:
-        loop = _select_and_log(loop, _filter_alleles(alleles), log,
-                               '{N} SNPs with valid alleles.')
+# data shared by the rg matrix worker processes, set by _rg_matrix_worker_init. The Hsq fits
+# and arrays are passed as Pool initargs so that each worker receives them once rather than
+# with every job. Workers share this memory only under the fork start method (the default on
+# Linux); under spawn or forkserver, each worker is sent a pickled copy of all of it.
+_RG_REF = {}
+
+
+def _rg_matrix_worker_init(args, z, N, ref_ld, w, M_annot, hsq):
+    _RG_REF.update(args=args, z=z, N=N, ref_ld=ref_ld, w=w, M_annot=M_annot, hsq=hsq)
+
+
+def _rg_matrix_worker(job):
+    '''
+    Estimate gencov and rg for the pair of traits (i, j) of estimate_rg_matrix, reusing the
+    h2 estimates of both traits. Returns the estimates, or the traceback of an error.
+
+    '''
+    i, j = job
+    d = _RG_REF
+    args = d['args']
+    try:
+        rghat = reg.RG(d['z'][:, i:i+1], d['z'][:, j:j+1], d['ref_ld'], d['w'],
+                       d['N'][:, i:i+1], d['N'][:, j:j+1], d['M_annot'],
+                       intercept_gencov=args.intercept_gencov, n_blocks=args.n_blocks,
+                       twostep=args.two_step, hsq1=d['hsq'][i], hsq2=d['hsq'][j],
+                       irwls_tol=args.irwls_tol, irwls_max_iter=args.irwls_max_iter)
+    except Exception:
+        return job, None, traceback.format_exc()
+
+    row = {'rg': rghat.rg_ratio, 'rg_se': rghat.rg_se, 'z': rghat.z, 'p': rghat.p,
+           'gencov': rghat.gencov.tot, 'gencov_se': rghat.gencov.tot_se,
+           'gcov_int': rghat.gencov.intercept,
+           'gcov_int_se': getattr(rghat.gencov, 'intercept_se', None)}
+    return job, row, None
+
+
+def estimate_rg_matrix(args, log):
+    '''
+    Estimate rg between all pairs of traits in --rg-matrix. The h2 regression of each trait
+    is run once, on the SNPs shared by all traits (with np.nan in neither column of
+    _align_sumstats), and reused for every pair that includes
+    it, so only the gencov regressions are run per pair (in args.n_jobs worker processes,
+    which share the data without copying only under the fork start method).
+    Writes k x k matrices of rg, gencov and their standard errors to
+    args.out.[rg/rg_se/gencov/gencov_se], with h2 and its SE on the diagonal of the gencov
+    matrices.
+
+    '''
+    args = copy.deepcopy(args)
+    rg_paths, rg_files = _parse_rg(args.rg_matrix)
+    n_pheno = len(rg_paths)
+    intercept_h2 = _per_trait_arg(args.intercept_h2, n_pheno, '--intercept-h2')
+    samp_prev = _per_trait_arg(args.samp_prev, n_pheno, '--samp-prev')
+    pop_prev = _per_trait_arg(args.pop_prev, n_pheno, '--pop-prev')
+    if args.intercept_gencov is not None:
+        if ',' in args.intercept_gencov:
+            raise ValueError('--intercept-gencov takes a single value with --rg-matrix.')
+        args.intercept_gencov = float(args.intercept_gencov)
+    if args.no_intercept:
+        intercept_h2 = [1 for _ in range(n_pheno)]
+        args.intercept_gencov = 0
+
+    M_annot, ref, ref_ld_cnames = _read_ref(args, log)
+    z, N, ok = _align_sumstats(args, log, rg_paths, ref)
+    z, N = z[:, ok], N[:, ok]
+    ii = ~np.isnan(z).any(axis=1)
+    _select_and_log(ii, ii, log, '{N} SNPs are present in all phenotypes.')
+    if args.chisq_max is not None:
+        # drop SNPs where the product of chi^2 statistics is too large for any pair
+        chisq = np.sort(np.square(z), axis=1)
+        ii &= chisq[:, -1]*chisq[:, -2] < args.chisq_max**2
+        log.log('Removed SNPs with chi^2 > {C} for some pair of phenotypes ({N} SNPs '
+                'remain)'.format(C=args.chisq_max, N=np.sum(ii)))
+
+    z, N = z[ii], N[ii]
+    ref_ld = np.array(ref[ref_ld_cnames])[ii]
+    w = np.array(ref.LD_weights)[ii].reshape((len(z), 1))
+    _check_ld_condnum(args, log, ref_ld)
+    _warn_length(log, z)
+    args.n_blocks = min(args.n_blocks, len(z))
+    if args.two_step is not None:
+        log.log('Using two-step estimator with cutoff at {M}.'.format(M=args.two_step))
+
+    l = lambda x: x + ''.join(['-' for i in range(len(x.replace('\n', '')))])
+    hsq = []
+    for k, i in enumerate(ok):
+        hsq.append(reg.Hsq(np.square(z[:, k:k+1]), ref_ld, w, N[:, k:k+1], M_annot,
+                           n_blocks=args.n_blocks, intercept=intercept_h2[i],
+                           twostep=args.two_step, irwls_tol=args.irwls_tol,
+                           irwls_max_iter=args.irwls_max_iter))
+        log.log(l('\nHeritability of phenotype {I}/{N}\n'.format(I=i + 1, N=n_pheno)))
+        log.log(hsq[k].summary(ref_ld_cnames, P=samp_prev[i], K=pop_prev[i]))
+
+    jobs = [(k1, k2) for k1 in range(len(ok)) for k2 in range(k1 + 1, len(ok))]
+    initargs = (args, z, N, ref_ld, w, M_annot, hsq)
+    n_jobs = max(min(args.n_jobs, len(jobs)), 1)
+    log.log('\nComputing rg for {P} pairs of phenotypes with {J} worker processes.'.format(
+        P=len(jobs), J=n_jobs))
+    pool = None
+    if n_jobs > 1:
+        pool = Pool(n_jobs, initializer=_rg_matrix_worker_init, initargs=initargs)
+        results = pool.imap(_rg_matrix_worker, jobs)
+    else:
+        _rg_matrix_worker_init(*initargs)
+        results = map(_rg_matrix_worker, jobs)
+
+    nan = lambda: pd.DataFrame(np.nan, index=rg_paths, columns=rg_paths)
+    out = {x: nan() for x in ('rg', 'rg_se', 'gencov', 'gencov_se')}
+    rows = []
+    try:
+        for (k1, k2), row, error in results:
+            p1, p2 = rg_paths[ok[k1]], rg_paths[ok[k2]]
+            if error is not None:
+                log.log('ERROR computing rg for phenotypes {F1} and {F2}.'.format(F1=p1, F2=p2))
+                log.log(error)
+                row = {}
+            for x in out:
+                out[x].loc[p1, p2] = out[x].loc[p2, p1] = row.get(x, np.nan)
+            row.update(p1=p1, p2=p2, h2_1=hsq[k1].tot, h2_2=hsq[k2].tot)
+            rows.append(row)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    for k, i in enumerate(ok):
+        out['rg'].iloc[i, i] = 1
+        out['gencov'].iloc[i, i] = hsq[k].tot
+        out['gencov_se'].iloc[i, i] = hsq[k].tot_se
+
+    for x in ('rg', 'rg_se', 'gencov', 'gencov_se'):
+        out[x].to_csv(args.out + '.' + x, sep='\t', na_rep='NA', index_label='trait')
+
+    columns = ['p1', 'p2', 'rg', 'rg_se', 'z', 'p', 'h2_1', 'h2_2', 'gencov', 'gencov_se',
+               'gcov_int', 'gcov_int_se']
+    x = pd.DataFrame(rows, columns=columns)
+    log.log('\nSummary of Genetic Correlation Results\n' +
+            x.to_string(header=True, index=False, na_rep='NA') + '\n')
+    log.log('rg and gencov matrices printed to {F}.[rg/rg_se/gencov/gencov_se]'.format(
+        F=args.out))
+    return out
+
 
-    loop['Z2'] = _align_alleles(loop.Z2, alleles)
-    loop = loop.drop(['A1', 'A1x', 'A2', 'A2x'], axis=1)
-    _check_ld_condnum(args, log, loop[ref_ld_cnames])
-    _warn_length(log, loop)
-    return loop
+def _align_sumstats(args, log, paths, ref):
+    '''
+    Read the summary statistics of many traits into (n_snp, n_trait) matrices of Z-scores
+    and sample sizes with one row per SNP in ref, in the order of ref, so that the SNPs
+    shared by any set of traits can be selected without merging. Z-scores are aligned to
+    the alleles of the first trait with each SNP (allowing for strand and ref allele
+    flips). Entries for SNPs that are missing from a trait or have mismatched alleles are
+    np.nan. With --no-check-alleles, mismatched alleles are an error for the trait, as in
+    _align_alleles. The matrices are memory-mapped from an anonymous temporary file, so that
+    they need not fit in memory.
+
+    Errors reading any trait but the first are logged and leave its column np.nan.
+
+    Returns
+    -------
+    z, N : np.memmap
+        Z-scores and sample sizes with shape (len(ref), len(paths)).
+    ok : list of int
+        Indices of traits that were read without errors.
+
+    '''
+    n_snp, n_trait = len(ref), len(paths)
+    snp_index = pd.Index(ref.SNP)
+    with tempfile.TemporaryFile() as f:
+        x = np.memmap(f, dtype=float, mode='w+', shape=(2, n_snp, n_trait))
+    x[:] = np.nan
+    z, N = x[0], x[1]
+    ref_alleles = np.full(n_snp, -1, dtype=np.int16)  # alleles of the first trait with a SNP
+    ok = []
+    for i, fh in enumerate(paths):
+        try:
+            sumstats = _read_sumstats(args, log, fh, alleles=True, dropna=True, snps=ref.SNP)
+            ii = snp_index.get_indexer(sumstats.SNP)
+            alleles = al.pair_codes(sumstats.A1, sumstats.A2)
+            sumstats, alleles, ii = sumstats[ii >= 0], alleles[ii >= 0], ii[ii >= 0]
+            ref_ii = ref_alleles[ii]
+            new = ref_ii < 0
+            ref_ii[new] = alleles[new]
+            codes = 25*ref_ii + alleles
+            keep = np.ones(len(ii), dtype=bool)
+            if not args.no_check_alleles:
+                keep = al.MATCH_TABLE[codes]
+                _select_and_log(keep, keep, log, '{N} SNPs with valid alleles.')
+            else:  # skip the validity checks, but never align mismatched alleles
+                bad = ~al.MATCH_TABLE[codes] & ~new
+                if bad.any():
+                    raise KeyError(
+                        'Incompatible alleles: ' + ', '.join(sumstats.SNP[bad][0:5]))
+            ref_alleles[ii[new]] = alleles[new]
+            sign = np.where(al.FLIP_TABLE[codes[keep]], -1, 1)
+            z[ii[keep], i] = sumstats.Z.values[keep] * sign
+            N[ii[keep], i] = sumstats.N.values[keep]
+            ok.append(i)
+        except Exception:
+            if i == 0:
+                raise
+            msg = 'ERROR reading phenotype {I}/{N}, from file {F}.'
+            log.log(msg.format(I=i + 1, N=n_trait, F=fh))
+            log.log(traceback.format_exc() + '\n')
+
+    return z, N, ok
 
 
 def _get_rg_table(rg_paths, RG, args):
@@ -379,8 +776,9 @@ def _get_rg_table(rg_paths, RG, args):
     x['p1'] = [rg_paths[0] for i in range(1, len(rg_paths))]
     x['p2'] = rg_paths[1:len(rg_paths)]
     x['rg'] = list(map(t('rg_ratio'), RG))
-    x['se'] = list(map(lambda y: round(y, 3), map(t('rg_se'), RG)))
-    x['z'] = list(map(lambda y: round(y, 3), map(t('z'), RG)))
+    r = lambda y: round(y, 3) if isinstance(y, float) else y  # 'NA' for failed traits
+    x['se'] = list(map(r, map(t('rg_se'), RG)))
+    x['z'] = list(map(r, map(t('z'), RG)))
     x['p'] = list(map(t('p'), RG))
     if args.samp_prev is not None and args.pop_prev is not None and\
             all((i is not None for i in args.samp_prev)) and all((i is not None for i in args.pop_prev)):
@@ -430,34 +828,34 @@ def _merge_sumstats_sumstats(args, sumstats1, sumstats2, log):
 
 def _filter_alleles(alleles):
     '''Remove bad variants (mismatched alleles, non-SNPs, strand ambiguous).'''
-    ii = alleles.apply(lambda y: y in MATCH_ALLELES)
-    return ii
+    return pd.Series(al.match(alleles), index=alleles.index)
 
 
 def _align_alleles(z, alleles):
     '''Align Z1 and Z2 to same choice of ref allele (allowing for strand flip).'''
-    z *= (-1) ** alleles.apply(lambda y: FLIP_ALLELES[y])
+    ii = al.match(alleles)
+    if not ii.all():
+        raise KeyError('Incompatible alleles: ' + ', '.join(alleles[~ii][0:5]))
+
+    z *= pd.Series(np.where(al.flip(alleles), -1, 1), index=alleles.index)
     return z
 
 
-def _rg(sumstats, args, log, M_annot, ref_ld_cnames, w_ld_cname, i):
-    '''Run the regressions.'''
-    n_snp = len(sumstats)
-    s = lambda x: np.array(x).reshape((n_snp, 1))
+def _rg(args, z1, z2, ref_ld, w, N1, N2, M_annot, i):
+    '''Run the regressions for phenotypes 1 and i + 2, on SNPs shared by both.'''
     if args.chisq_max is not None:
-        ii = sumstats.Z1**2*sumstats.Z2**2 < args.chisq_max**2
-        n_snp = np.sum(ii)  # lambdas are late binding, so this works
-        sumstats = sumstats[ii]
+        ii = z1**2*z2**2 < args.chisq_max**2
+        z1, z2, ref_ld, w, N1, N2 = (x[ii] for x in (z1, z2, ref_ld, w, N1, N2))
 
+    n_snp = len(z1)
+    s = lambda x: np.array(x).reshape((n_snp, 1))
     n_blocks = min(args.n_blocks, n_snp)
-    ref_ld = sumstats.as_matrix(columns=ref_ld_cnames)
     intercepts = [args.intercept_h2[0], args.intercept_h2[
         i + 1], args.intercept_gencov[i + 1]]
-    rghat = reg.RG(s(sumstats.Z1), s(sumstats.Z2),
-                   ref_ld, s(sumstats[w_ld_cname]), s(
-                       sumstats.N1), s(sumstats.N2), M_annot,
+    rghat = reg.RG(s(z1), s(z2), ref_ld, s(w), s(N1), s(N2), M_annot,
                    intercept_hsq1=intercepts[0], intercept_hsq2=intercepts[1],
-                   intercept_gencov=intercepts[2], n_blocks=n_blocks, twostep=args.two_step)
+                   intercept_gencov=intercepts[2], n_blocks=n_blocks, twostep=args.two_step,
+                   irwls_tol=args.irwls_tol, irwls_max_iter=args.irwls_max_iter)
 
     return rghat
 
@@ -1,14 +1,15 @@
 from __future__ import division
 import pandas as pd
 import numpy as np
-import os
 import sys
 import traceback
 import gzip
 import bz2
 import argparse
 from scipy.stats import chi2
-from ldscore import sumstats
+from ldscore import alleles as al
+from ldscore import output
+from ldscore import parse
 from ldsc import MASTHEAD, Logger, sec_to_str
 import time
 np.seterr(invalid='ignore')
@@ -211,7 +212,7 @@ def filter_frq(frq, log, args):
 
 def filter_alleles(a):
     '''Remove alleles that do not describe strand-unambiguous SNPs'''
-    return a.isin(sumstats.VALID_SNPS)
+    return pd.Series(al.valid(a), index=a.index)
 
 
 def parse_dat(dat_gen, convert_colname, merge_alleles, log, args):
@@ -386,8 +387,7 @@ def allele_merge(dat, alleles, log):
     Note: dat now has the same SNPs in the same order as --merge alleles.
     '''
     dat = pd.merge(alleles, dat, how='left', on='SNP', sort=False).reset_index(drop=True)
-    match = dat.apply(lambda x: (x.A1 + x.A2 + x.MA) in
-                                sumstats.MATCH_ALLELES if x.A1 is not np.nan else False, axis=1)
+    match = al.MATCH_TABLE[25*al.pair_codes(dat.A1, dat.A2) + al.encode(dat.MA, 2)]
     allele_not_in_ref = len(dat[~dat.A1.notnull()].index)
     n_mismatch = (~match).sum() - allele_not_in_ref
 
@@ -467,6 +467,12 @@ parser.add_argument('--ignore', default=None, type=str,
     help='Comma-separated list of column names to ignore.')
 parser.add_argument('--a1-inc', default=False, action='store_true',
     help='A1 is the increasing allele.')
+parser.add_argument('--sumstats-format', default='txt', type=str, choices=['txt', 'npz'],
+    help='Format of the output: gzipped text (.sumstats.gz, txt) or an indexed binary file '
+    '(.sumstats.npz, npz), from which ldsc.py reads only the SNPs and columns it needs.')
+parser.add_argument('--bgzf-threads', default=None, type=int,
+    help='Write the .sumstats.gz file as block gzip (BGZF), compressed with this many '
+    'threads. BGZF files can be read like any other .gz file.')
 
 
 def munge_sumstats(args, p=True):  # set p = False for testing in order to prevent printing
@@ -594,11 +600,14 @@ def munge_sumstats(args, p=True):  # set p = False for testing in order to preve
 
     out_fname = args.out+'.sumstats'
     print_colnames = [c for c in dat.columns if c in ['SNP', 'N', 'Z', 'A1', 'A2']]
+    out_suffix = '.npz' if args.sumstats_format == 'npz' else '.gz'
     msg = 'Writing summary statistics for {M} SNPs ({N} with nonmissing beta) to {F}.'
-    log.log(msg.format(M=len(dat), F=out_fname+'.gz', N=dat.N.notnull().sum()))
-    if p:
-        dat.to_csv(out_fname, sep="\t", index=False, columns=print_colnames, float_format='%.3f')
-        os.system('gzip -f {F}'.format(F=out_fname))
+    log.log(msg.format(M=len(dat), F=out_fname+out_suffix, N=dat.N.notnull().sum()))
+    if p and args.sumstats_format == 'npz':
+        parse.write_sumstats_npz(out_fname + out_suffix, dat[print_colnames])
+    elif p:
+        output.write_csv_gz(dat, out_fname + out_suffix, threads=args.bgzf_threads, sep="\t",
+            index=False, columns=print_colnames, float_format='%.3f')
 
     log.log('\nMetadata:')
     CHISQ = (dat.Z**2)
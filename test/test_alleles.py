@@ -0,0 +1,39 @@
+from __future__ import division
+import ldscore.alleles as al
+import numpy as np
+import pandas as pd
+import itertools as it
+from nose.tools import *
+from numpy.testing import assert_array_equal
+
+# all strings of 2 and 4 characters from ACGT and an invalid base, plus odd cases
+PAIRS = [''.join(x) for x in it.product('ACGTN', repeat=2)] + \
+    ['', 'A', 'AAT', 'DI', 'ac', np.nan]
+PAIRS_OF_PAIRS = [''.join(x) for x in it.product('ACGTN', repeat=4)] + \
+    ['', 'ACG', 'ACGTA', 'DIID', 'acgt', np.nan]
+
+
+def test_encode():
+    assert_array_equal(al.encode(['AC', 'TG', 'CC']), [1, 17, 6])
+    assert_array_equal(al.encode(['ACGT'], 4), [1*25 + 2*5 + 3])
+    assert_array_equal(al.pair_codes(['A', 'T'], ['C', 'G']), [1, 17])
+    assert_equal(len(al.encode([], 4)), 0)
+    # invalid strings have codes containing an invalid base
+    for x in ['AN', 'A', 'AAT', 'ac', np.nan]:
+        code = al.encode([x])[0]
+        assert code // 5 == 4 or code % 5 == 4
+
+
+def test_valid():
+    assert_array_equal(al.valid(PAIRS), [x in al.VALID_SNPS for x in PAIRS])
+    assert_array_equal(al.valid(pd.Series(['AC', 'AT'])), [True, False])
+
+
+def test_match():
+    assert_array_equal(al.match(PAIRS_OF_PAIRS),
+                       [x in al.MATCH_ALLELES for x in PAIRS_OF_PAIRS])
+
+
+def test_flip():
+    assert_array_equal(al.flip(PAIRS_OF_PAIRS),
+                       [al.FLIP_ALLELES.get(x, False) for x in PAIRS_OF_PAIRS])
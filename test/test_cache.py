@@ -0,0 +1,79 @@
+from __future__ import division
+from ldscore.cache import RefCache
+import ldscore.parse as ps
+import unittest
+import numpy as np
+import pandas as pd
+import os
+import tempfile
+from nose.tools import *
+
+DIR = os.path.dirname(__file__)
+
+
+class Test_RefCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = RefCache(os.path.join(self.dir, 'cache'))
+        self.calls = 0
+
+    def parse(self, flist, num=None):
+        self.calls += 1
+        return ps.ldscore_fromlist(flist, num)
+
+    def test_ldscore(self):
+        fh = [os.path.join(DIR, 'parse_test/test')]
+        fnames = ps.ldscore_files(fh, 2)
+        x, hit = self.cache.get('ldscore', fnames, lambda: self.parse(fh, 2))
+        assert not hit
+        y, hit = self.cache.get('ldscore', fnames, lambda: self.parse(fh, 2))
+        assert hit
+        assert_equal(self.calls, 1)
+        assert_equal(list(x.columns), list(y.columns))
+        assert np.all(x.SNP.values == y.SNP.values)
+        assert np.all(x.iloc[:, 1:].values == y.iloc[:, 1:].values)
+        # a different parser is a different entry
+        self.cache.get('other', fnames, lambda: self.parse(fh, 2))
+        assert_equal(self.calls, 2)
+
+    def test_array(self):
+        x = np.arange(6.0).reshape((1, 6))
+        fname = os.path.join(self.dir, 'M')
+        open(fname, 'w').write('1')
+        self.cache.get('M', [fname], lambda: x)
+        y, hit = self.cache.get('M', [fname], lambda: None)
+        assert hit
+        assert np.all(x == y)
+        # changing the file invalidates the entry
+        open(fname, 'w').write('12')
+        y, hit = self.cache.get('M', [fname], lambda: x + 1)
+        assert not hit
+        assert np.all(x + 1 == y)
+
+    def test_corrupt(self):
+        x = np.arange(6.0).reshape((1, 6))
+        fname = os.path.join(self.dir, 'M')
+        open(fname, 'w').write('1')
+        self.cache.get('M', [fname], lambda: x)
+        entry = self.cache.entries()[0][-1]
+        data = open(entry, 'rb').read()
+        # garbage, a truncated entry and an empty file are cache misses
+        for bad in [b'garbage', data[0:len(data)//2], b'']:
+            open(entry, 'wb').write(bad)
+            y, hit = self.cache.get('M', [fname], lambda: x + 1)
+            assert not hit
+            assert np.all(x + 1 == y)
+
+    def test_evict(self):
+        cache = RefCache(os.path.join(self.dir, 'small'), max_size=0)
+        fname = os.path.join(self.dir, 'M')
+        open(fname, 'w').write('1')
+        for i in range(3):
+            cache.get(str(i), [fname], lambda: np.zeros(100))
+        # only the newest entry is kept
+        assert_equal(len(cache.entries()), 1)
+        assert cache.get('2', [fname], lambda: None)[1]
+
+    def test_bad_size(self):
+        assert_raises(ValueError, RefCache, self.dir, -1)
@@ -3,7 +3,7 @@ from ldscore.irwls import IRWLS
 import unittest
 import numpy as np
 from numpy.testing import assert_array_equal, assert_array_almost_equal
-from nose.tools import assert_raises
+from nose.tools import assert_raises, assert_equal
 
 
 class Test_IRWLS_2D(unittest.TestCase):
@@ -66,3 +66,60 @@ class Test_IRWLS_1D(unittest.TestCase):
         z = IRWLS(self.x, self.y, self.update_func, 2)
         assert_array_equal(z.est.shape, (1, 1))
         assert_array_almost_equal(z.est, 1)
+
+
+class Test_IRWLS_Normal_Equations(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.random.normal(size=(20000, 5))
+        self.y = np.random.normal(size=(20000, 1))
+        self.w = np.abs(np.random.normal(size=(20000, 1)))
+
+    def test_wls_eq_lstsq(self):
+        z = IRWLS.wls(self.x, self.y, self.w)
+        coef, _, _, sv = np.linalg.lstsq(
+            IRWLS._weight(self.x, self.w), IRWLS._weight(self.y, self.w), rcond=None)
+        assert_array_almost_equal(z[0], coef)
+        assert_array_almost_equal(z[3], sv)
+
+    def test_wls_matrix(self):
+        z1 = IRWLS.wls(self.x, self.y, self.w)
+        z2 = IRWLS.wls(np.matrix(self.x), np.matrix(self.y), np.matrix(self.w))
+        assert_array_almost_equal(z1[0], z2[0])
+
+    def test_irwls_matrix(self):
+        update_func = lambda a: 1 + np.abs(np.dot(self.x, a[0]))
+        z1 = IRWLS(self.x, self.y, update_func, 10, w=self.w)
+        z2 = IRWLS(np.matrix(self.x), np.matrix(self.y), update_func, 10,
+                   w=np.matrix(self.w))
+        assert_array_almost_equal(z1.est, z2.est)
+        assert_array_almost_equal(z1.delete_values, z2.delete_values)
+
+    def test_wls_ill_conditioned(self):
+        # collinear columns: falls back to the minimum norm lstsq solution
+        x = np.hstack([self.x, self.x[:, 0:1]])
+        z = IRWLS.wls(x, self.y, self.w)
+        coef = np.linalg.lstsq(
+            IRWLS._weight(x, self.w), IRWLS._weight(self.y, self.w), rcond=None)[0]
+        assert_array_almost_equal(z[0], coef)
+
+    def test_irwls_eq_slow(self):
+        update_func = lambda a: 1 + np.abs(np.dot(self.x, a[0]))
+        z1 = IRWLS(self.x, self.y, update_func, 10, w=self.w)
+        z2 = IRWLS(self.x, self.y, update_func, 10, w=self.w, slow=True)
+        assert_array_almost_equal(z1.est, z2.est)
+        assert_array_almost_equal(z1.delete_values, z2.delete_values)
+
+    def test_tol(self):
+        update_func = lambda a: 1 + np.abs(np.dot(self.x, a[0]))
+        z = IRWLS(self.x, self.y, update_func, 10, w=self.w)
+        assert_equal(z.n_iter, 2)
+        z = IRWLS(self.x, self.y, update_func, 10, w=self.w, tol=np.inf, max_iter=5)
+        assert_equal(z.n_iter, 1)
+        # converged weights: more passes do not change the estimate
+        z1 = IRWLS(self.x, self.y, update_func, 10, w=self.w, tol=1e-12, max_iter=50)
+        z2 = IRWLS(self.x, self.y, update_func, 10, w=self.w, max_iter=z1.n_iter + 5)
+        assert z1.n_iter < 50
+        assert_array_almost_equal(z1.est, z2.est)
+        assert_raises(ValueError, IRWLS, self.x, self.y, update_func, 10, max_iter=0)
+
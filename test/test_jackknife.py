@@ -200,6 +200,56 @@ class Test_LsqtsqJackknifeFast(unittest.TestCase):
             b2 = jk.LstsqJackknifeSlow(x, y, n_blocks=n_blocks).est
             assert_array_almost_equal(b1, b2)
 
+    def test_delete_eq_slow(self):
+        x = np.random.normal(size=(200, 5))
+        y = np.random.normal(size=(200, 1))
+        for s in [[0, 100, 200], [0, 1, 50, 199, 200], range(0, 201, 10)]:
+            b1 = jk.LstsqJackknifeFast(x, y, separators=s).delete_values
+            b2 = jk.LstsqJackknifeSlow(x, y, separators=s).delete_values
+            assert_array_almost_equal(b1, b2)
+
+    def test_weights(self):
+        x = np.random.normal(size=(200, 20))
+        y = np.random.normal(size=(200, 1))
+        w = np.random.uniform(size=(200, 1))
+        for n_blocks in [10, 100]:
+            b1 = jk.LstsqJackknifeFast(x, y, n_blocks=n_blocks, w=w)
+            b2 = jk.LstsqJackknifeFast(x * w, y * w, n_blocks=n_blocks)
+            assert_array_almost_equal(b1.est, b2.est)
+            assert_array_almost_equal(b1.delete_values, b2.delete_values)
+
+    def test_weights_matrix(self):
+        x = np.random.normal(size=(200, 20))
+        y = np.random.normal(size=(200, 1))
+        w = np.random.uniform(size=(200, 1))
+        b1 = jk.LstsqJackknifeFast(x, y, n_blocks=10, w=w)
+        b2 = jk.LstsqJackknifeFast(
+            np.matrix(x), np.matrix(y), n_blocks=10, w=np.matrix(w))
+        assert_array_almost_equal(b1.est, b2.est)
+        assert_array_almost_equal(b1.delete_values, b2.delete_values)
+
+    def test_delete_woodbury(self):
+        x = np.random.normal(size=(200, 20))
+        y = np.random.normal(size=(200, 1))
+        # small blocks are downdated, large blocks are solved directly
+        for s in [range(0, 201, 2), [0, 1, 2, 5, 100, 200], [0, 3, 3, 200]]:
+            xty, xtx = jk.LstsqJackknifeFast.block_values(x, y, s)
+            b1 = jk.LstsqJackknifeFast.block_values_to_delete_values_woodbury(
+                x, s, xty, xtx)
+            b2 = jk.LstsqJackknifeFast.block_values_to_delete_values(xty, xtx)
+            assert_array_almost_equal(b1, b2)
+
+        b1 = jk.LstsqJackknifeFast(x, y, n_blocks=100).delete_values
+        b2 = jk.LstsqJackknifeSlow(x, y, n_blocks=100).delete_values
+        assert_array_almost_equal(b1, b2)
+        # removing block 0 leaves an almost singular design matrix: solve directly
+        x[2:, 0] *= 1e-6
+        s = range(0, 201, 2)
+        xty, xtx = jk.LstsqJackknifeFast.block_values(x, y, s)
+        b1 = jk.LstsqJackknifeFast.block_values_to_delete_values_woodbury(x, s, xty, xtx)
+        b2 = jk.LstsqJackknifeFast.block_values_to_delete_values(xty, xtx)
+        assert_array_almost_equal(b1, b2)
+
     def test_bad_data(self):
         x = np.arange(6).reshape((1, 6))
         assert_raises(ValueError, jk.LstsqJackknifeFast, x, x, n_blocks=3)
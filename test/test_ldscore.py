@@ -1,10 +1,13 @@
 import ldscore.ldscore as ld
 import unittest
-import bitarray as ba
 import numpy as np
 import os
+import tempfile
 import nose
 import ldscore.parse as ps
+import ldsc
+import pandas as pd
+from scipy import sparse
 
 
 ##########################################################################
@@ -19,12 +22,33 @@ def test_getBlockLefts():
     assert np.all([np.all(ld.getBlockLefts(coor, max_d) == ca) for coor, max_d, ca in zip(coords, max_dist, correct)])
 
 
+def test_getBlockLefts_multiple_windows():
+    coords = np.column_stack((np.arange(1, 7), (1, 4, 6, 7, 7, 8)))
+    block_left = ld.getBlockLefts(coords, (1, 2))
+    assert block_left.dtype.kind == 'i'
+    assert np.all(block_left == np.column_stack(((0, 0, 1, 2, 3, 4), (0, 1, 1, 2, 2, 2))))
+    block_right = ld.block_left_to_right(block_left)
+    assert np.all(block_right == np.column_stack(((2, 3, 4, 5, 6, 6), (1, 3, 6, 6, 6, 6))))
+
+
 def test_block_left_to_right():
     block_left = ((0, 0, 0, 0, 0),(0, 1, 2, 3, 4, 5), (0, 0, 2, 2))
     correct_answer = ((5, 5, 5, 5, 5), (1, 2, 3, 4, 5, 6),(2, 2, 4, 4) )
     assert np.all(([np.all(ld.block_left_to_right(bl) == ca) for bl, ca in zip(block_left, correct_answer)]))
 
 
+def test_decode_bed():
+    # genotypes 0, missing, 1, 2 and 2, 2, 0, pad
+    packed = np.array([[0b11100100], [0b00001111]], dtype=np.uint8)
+    x = ld.decode_bed(packed, 3)
+    assert x.shape == (3, 2)
+    assert np.allclose(x[:, 0], np.sqrt(1.5)*np.array([-1, 0, 1]))
+    assert np.allclose(x[:, 1], [1/np.sqrt(2), 1/np.sqrt(2), -np.sqrt(2)])
+    y = ld.decode_bed(packed, 3, flip=np.array([False, True]))
+    assert np.allclose(x[:, 0], y[:, 0])
+    assert np.allclose(x[:, 1], -y[:, 1])
+
+
 ##########################################################################
 #                                    BED PARSER                          #
 ##########################################################################
@@ -33,6 +57,13 @@ def test_block_left_to_right():
 PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 PLINK_TEST_FILES_DIR = os.path.join(PROJECT_PATH, 'test/plink_test/')
 
+
+def genotypes(bed, j):
+    '''Genotype codes (0, 1, 2, 9 = missing) of the j-th SNP that passed filtering.'''
+    packed = bed.__packed_rows__(bed.geno, bed.kept_snps[j:j+1])
+    return ld._BED_LOOKUP[packed].ravel()[0:bed.n]
+
+
 class test_bed(unittest.TestCase):
 
     def setUp(self):
@@ -49,9 +80,10 @@ class test_bed(unittest.TestCase):
         # no individuals removed
         print(bed.n)
         assert self.N == bed.n
-        # 5 indivs * 4 polymorphic SNPs
-        print(len(bed.geno))
-        assert len(bed.geno) == 64
+        # packed genotypes are not copied, only the indices of the 4 polymorphic SNPs
+        print(bed.kept_snps)
+        assert bed.geno.shape == (8, 2)
+        assert np.all(bed.kept_snps == [4, 5, 6, 7])
         print(bed.freq)
         correct = np.array(
             [0.59999999999999998, 0.59999999999999998, 0.625, 0.625])
@@ -63,8 +95,7 @@ class test_bed(unittest.TestCase):
                               keep_snps=keep_snps)
         assert bed.m == 1
         assert bed.n == 5
-    # pad bits are initialized with random memory --> can't test them
-        assert bed.geno[0:10] == ba.bitarray('0001011111')
+        assert np.all(genotypes(bed, 0) == [0, 1, 1, 2, 2])
 
     def test_filter_indivs(self):
         keep_indivs = [0, 1]
@@ -72,9 +103,8 @@ class test_bed(unittest.TestCase):
                               keep_indivs=keep_indivs)
         assert bed.m == 2
         assert bed.n == 2
-        # pad bits are initialized with random memory --> can't test them
-        assert bed.geno[0:4] == ba.bitarray('0001')
-        assert bed.geno[8:12] == ba.bitarray('0001')
+        assert np.all(genotypes(bed, 0) == [0, 1])
+        assert np.all(genotypes(bed, 1) == [0, 1])
 
     def test_filter_indivs_and_snps(self):
         keep_indivs = [0, 1]
@@ -83,8 +113,7 @@ class test_bed(unittest.TestCase):
                               keep_snps=keep_snps, keep_indivs=keep_indivs)
         self.assertEqual(bed.m, 1)
         self.assertEqual(bed.n, 2)
-        print(bed.geno)
-        self.assertTrue(bed.geno[0:4] == ba.bitarray('0001'))
+        self.assertTrue(np.all(genotypes(bed, 0) == [0, 1]))
 
     @nose.tools.raises(ValueError)
     def test_bad_filename(self):
@@ -119,3 +148,107 @@ class test_bed(unittest.TestCase):
         bed._currentSNP -= b
         y = bed.nextSNPs(b, minorRef=True)
         assert np.all(x == -y)
+
+    def test_ldScoreVarBlocks(self):
+        bed = ld.PlinkBEDFile(os.path.join(PLINK_TEST_FILES_DIR, 'plink.bed'), self.N, self.bim)
+        x = bed.nextSNPs(4)
+        r2 = np.square(np.dot(x.T, x / self.N))
+        r2 = r2 - (1 - r2) / (self.N - 2)
+        annot = np.array([[1, 0], [0, 0], [0, 0], [1, 1]], dtype=float)
+        for block_left, c in [(np.zeros(4), 1), (np.array([0, 0, 1, 2]), 1), (np.arange(4), 2),
+                              (np.array([0, 0, 2, 2]), 2), (np.zeros(4), 3)]:
+            in_window = np.abs(np.subtract.outer(np.arange(4), np.arange(4))) <= \
+                np.arange(4) - np.array([block_left[c*(i // c)] for i in range(4)])
+            in_window = in_window | in_window.T
+            bed._currentSNP = 0
+            assert np.allclose(bed.ldScoreVarBlocks(block_left, c, annot=annot),
+                               np.dot(r2*in_window, annot))
+
+    def test_ldScoreVarBlocks_segments(self):
+        bed = ld.PlinkBEDFile(os.path.join(PLINK_TEST_FILES_DIR, 'plink.bed'), self.N, self.bim)
+        annot = np.array([[1, 0], [0, 0], [0, 0], [1, 1]], dtype=float)
+        for block_left, c in [(np.zeros(4), 1), (np.array([0, 0, 1, 2]), 1), (np.arange(4), 2)]:
+            bed._currentSNP = 0
+            x = bed.ldScoreVarBlocks(block_left, c, annot=annot)
+            for n_segments in [2, 3, 4]:
+                y = bed.ldScoreVarBlocks(block_left, c, annot=annot, n_segments=n_segments)
+                assert np.allclose(x, y)
+            # segments don't move the SNP cursor
+            self.assertEqual(bed._currentSNP, 4)
+
+    def test_ldScoreVarBlocks_float32(self):
+        bed = ld.PlinkBEDFile(os.path.join(PLINK_TEST_FILES_DIR, 'plink.bed'), self.N, self.bim)
+        self.assertEqual(bed.nextSNPs(4, dtype=np.float32).dtype, np.float32)
+        block_left = np.array([0, 0, 1, 2])
+        bed._currentSNP = 0
+        l2 = bed.ldScoreVarBlocks(block_left, 1)
+        bed._currentSNP = 0
+        l2_32 = bed.ldScoreVarBlocks(block_left, 1, dtype=np.float32)
+        self.assertEqual(l2_32.dtype, np.float64)
+        assert np.allclose(l2, l2_32, atol=1e-5)
+        s, e, dev = bed.ldScoreDeviation(block_left, 1)
+        assert 0 <= s < e <= 4 and dev < 1e-5
+
+    def test_ldScoreVarBlocks_sparse(self):
+        bed = ld.PlinkBEDFile(os.path.join(PLINK_TEST_FILES_DIR, 'plink.bed'), self.N, self.bim)
+        annot = np.array([[1, 0, 0], [0, 0, 0], [0, 0, 0], [1, 1, 0]], dtype=float)
+        for block_left, c in [(np.zeros(4), 1), (np.array([0, 0, 1, 2]), 1), (np.arange(4), 2)]:
+            bed._currentSNP = 0
+            x = bed.ldScoreVarBlocks(block_left, c, annot=annot)
+            for sparse_annot in [sparse.csr_matrix(annot), sparse.csc_matrix(annot)]:
+                bed._currentSNP = 0
+                assert np.allclose(x, bed.ldScoreVarBlocks(block_left, c, annot=sparse_annot))
+
+    def test_ldScoreVarBlocks_checkpoint(self):
+        bed = ld.PlinkBEDFile(os.path.join(PLINK_TEST_FILES_DIR, 'plink.bed'), self.N, self.bim)
+        block_left = np.array([0, 0, 1, 2])
+        x = bed.ldScoreVarBlocks(block_left, 1)
+
+        class Interrupt(Exception):
+            pass
+
+        def save_and_interrupt(l_B, snp, cor_sum):
+            ld.Checkpoint.save(checkpoint, l_B, snp, cor_sum)
+            raise Interrupt
+
+        fname = os.path.join(tempfile.mkdtemp(), 'test.ckpt.npz')
+        checkpoint = ld.Checkpoint(fname, 1, 'key')
+        checkpoint.save = save_and_interrupt
+        bed._currentSNP = 0
+        self.assertRaises(Interrupt, bed.ldScoreVarBlocks, block_left, 1, checkpoint=checkpoint)
+        self.assertRaises(ValueError, ld.Checkpoint, fname, 1, 'other key', resume=True)
+        checkpoint = ld.Checkpoint(fname, 1, 'key', resume=True)
+        self.assertEqual(checkpoint.state['l_B'], 3)
+        self.assertEqual(checkpoint.state['snp'], 2)
+        y = bed.ldScoreVarBlocks(block_left, 1, checkpoint=checkpoint)
+        assert np.allclose(x, y)
+        checkpoint.remove()
+        assert not os.path.exists(fname)
+
+
+def test_ldsc_l2_keep_extract():
+    # ldsc.py --l2 --bfile ... --keep/--extract, end to end
+    d = tempfile.mkdtemp()
+    keep, extract = os.path.join(d, 'keep'), os.path.join(d, 'extract')
+    with open(keep, 'w') as f:
+        f.write('per0\nper1\nper2\nper3\n')
+    with open(extract, 'w') as f:
+        f.write('rs_4\nrs_5\nrs_6\nrs_7\n')
+    bfile = os.path.join(PLINK_TEST_FILES_DIR, 'plink')
+    bim = ps.PlinkBIMFile(bfile + '.bim')
+    for flags, keep_snps, keep_indivs in [(['--keep', keep], None, [0, 1, 2, 3]),
+                                          (['--extract', extract], [4, 5, 6, 7], None)]:
+        out = os.path.join(d, flags[0][2:])
+        args = ldsc.parser.parse_args(['--l2', '--bfile', bfile, '--ld-wind-snps', '3',
+                                       '--yes-really', '--out', out] + flags)
+        log = ldsc.Logger(out + '.log')
+        try:
+            ldsc.ldscore(args, log)
+        finally:
+            log.log_fh.close()
+        x = pd.read_csv(out + '.l2.ldscore.gz', sep='\t')
+        bed = ld.PlinkBEDFile(bfile + '.bed', 5, bim, keep_snps=keep_snps,
+                              keep_indivs=keep_indivs)
+        block_left = ld.getBlockLefts(np.arange(bed.m), 3)
+        assert np.all(x.SNP.values == bim.df.SNP.values[bed.kept_snps])
+        assert np.allclose(x.L2, bed.ldScoreVarBlocks(block_left, 50).ravel(), atol=1e-3)
@@ -0,0 +1,78 @@
+from __future__ import division
+import ldscore.output as output
+import unittest
+import numpy as np
+import pandas as pd
+import gzip
+import os
+import struct
+import tempfile
+from nose.tools import *
+
+
+def bgzf_blocks(fname):
+    '''Splits a BGZF file into blocks, using the block sizes in the BC extra fields.'''
+    with open(fname, 'rb') as f:
+        data = f.read()
+
+    blocks = []
+    i = 0
+    while i < len(data):
+        id1, id2, cm, flg, mtime, xfl, os_, xlen, si1, si2, slen, bsize = \
+            struct.unpack('<BBBBIBBHBBHH', data[i:i+18])
+        assert_equal((id1, id2, flg, si1, si2), (31, 139, 4, 66, 67))
+        blocks.append(data[i:i+bsize+1])
+        i += bsize + 1
+
+    assert_equal(i, len(data))
+    return blocks
+
+
+class Test_write_csv_gz(unittest.TestCase):
+
+    def setUp(self):
+        n = 20000
+        self.df = pd.DataFrame({'SNP': ['rs' + str(i) for i in range(n)],
+                                'Z': np.linspace(-5, 5, n), 'N': 1000.0})
+        self.dir = tempfile.mkdtemp()
+        self.text = self.df.to_csv(sep='\t', index=False, float_format='%.3f').encode()
+
+    def test_gzip(self):
+        fname = os.path.join(self.dir, 'test.gz')
+        output.write_csv_gz(self.df, fname, chunksize=777, sep='\t', index=False,
+                            float_format='%.3f')
+        with gzip.open(fname) as f:
+            assert_equal(f.read(), self.text)
+
+    def test_bgzf(self):
+        for threads in [1, 3]:
+            fname = os.path.join(self.dir, 'test{}.gz'.format(threads))
+            output.write_csv_gz(self.df, fname, threads=threads, chunksize=777, sep='\t',
+                                index=False, float_format='%.3f')
+            with gzip.open(fname) as f:
+                assert_equal(f.read(), self.text)
+
+            blocks = bgzf_blocks(fname)
+            assert len(blocks) > 2
+            assert_equal(blocks[-1], output._BGZF_EOF)
+            x = pd.read_csv(fname, sep='\t')
+            assert_equal(len(x), len(self.df))
+
+    def test_empty(self):
+        fname = os.path.join(self.dir, 'empty.gz')
+        output.write_csv_gz(self.df.iloc[0:0], fname, threads=2, sep='\t', index=False)
+        with gzip.open(fname) as f:
+            assert_equal(f.read(), b'SNP\tZ\tN\n')
+
+    def test_bad_threads(self):
+        assert_raises(ValueError, output.open_gzip, os.path.join(self.dir, 'x.gz'), 0)
+
+    def test_error(self):
+        # an error while writing removes the partial file rather than marking it complete
+        for threads in [None, 2]:
+            fname = os.path.join(self.dir, 'error{}.gz'.format(threads))
+            with assert_raises(RuntimeError):
+                with output.open_gzip(fname, threads=threads) as f:
+                    f.write(self.text)
+                    raise RuntimeError
+            assert not os.path.exists(fname)
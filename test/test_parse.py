@@ -5,6 +5,7 @@ import numpy as np
 import pandas as pd
 import nose
 import os
+import tempfile
 from nose.tools import *
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 
@@ -43,6 +44,27 @@ def test_read_sumstats():
         DIR, 'parse_test/test.l2.ldscore.gz'))
 
 
+def test_sumstats_npz():
+    x = pd.DataFrame({'SNP': ['rs3', 'rs1', 'rs20', 'rs2'], 'A1': ['A', 'C', 'G', 'T'],
+                      'A2': ['G', 'T', 'A', 'C'], 'N': [10.0, 20.0, 30.0, np.nan],
+                      'Z': [1.0, -2.5, 0.123456789, 4.0]})
+    fh = os.path.join(tempfile.mkdtemp(), 'test.sumstats.npz')
+    ps.write_sumstats_npz(fh, x)
+    arrays = ps.npz_memmap(fh)
+    assert_array_equal(arrays['SNP'], [b'rs1', b'rs2', b'rs20', b'rs3'])
+    y = ps.sumstats(fh, alleles=True, dropna=False)
+    assert_array_equal(y.columns, ['SNP', 'Z', 'N', 'A1', 'A2'])
+    assert_array_equal(y.SNP, x.SNP)
+    assert_array_equal(y.A1, x.A1)
+    assert_array_equal(y.Z, x.Z)
+    y = ps.sumstats(fh)
+    assert_array_equal(y.columns, ['SNP', 'Z', 'N'])
+    assert_array_equal(y.SNP, ['rs3', 'rs1', 'rs20'])
+    y = ps.sumstats(fh, snps=['rs20', 'rs0', 'rs3', 'rs99'])
+    assert_array_equal(y.SNP, ['rs3', 'rs20'])
+    assert_array_equal(y.Z, [1.0, 0.123456789])
+
+
 def test_frq_parser():
     x = ps.frq_parser(os.path.join(DIR, 'parse_test/test1.frq'), compression=None)
     assert_array_equal(x.columns, ['SNP', 'FRQ'])
@@ -54,6 +76,18 @@ def test_frq_parser():
     assert_array_equal(x.FRQ, [.01, .1, .3, .2, .2, .2, .01, .03])
 
 
+def test_columnar():
+    df = pd.DataFrame({'CHR': [1, 1], 'SNP': ['rs1', 'rs2'], 'BP': [5, 10],
+                       'L2': [1/3, 2.123456789]})
+    fh = os.path.join(tempfile.mkdtemp(), 'test.npz')
+    ps.write_columnar(fh, df)
+    x = ps.read_columnar(fh)
+    assert_array_equal(x.columns, df.columns)
+    assert_array_equal(x.SNP, df.SNP)
+    assert_array_equal(x.BP, df.BP)
+    assert_array_equal(x.L2, df.L2)  # full precision
+
+
 class Test_ldscore(unittest.TestCase):
 
     def test_ldscore(self):
@@ -68,6 +102,18 @@ class Test_ldscore(unittest.TestCase):
         assert_equal(list(x['AL2']),list(range(1, 3)))
         assert_equal(list(x['BL2']), list(range(2, 6, 2)))
 
+    def test_ldscore_npz(self):
+        d = tempfile.mkdtemp()
+        for i in range(1, 3):
+            df = pd.DataFrame({'CHR': [i, i], 'SNP': ['rs' + str(2*i), 'rs' + str(2*i-1)],
+                               'BP': [2, 1], 'L2': [2*i+0.5, 2*i-0.5]})
+            ps.write_columnar(os.path.join(d, 'test{}.l2.ldscore.npz'.format(i)), df)
+        x = ps.ldscore(os.path.join(d, 'test'), 2)
+        assert_equal(list(x['SNP']), ['rs1', 'rs2', 'rs3', 'rs4'])
+        assert_equal(list(x['L2']), [1.5, 2.5, 3.5, 4.5])
+        x = ps.ldscore(os.path.join(d, 'test1'))
+        assert_equal(list(x.columns), ['SNP', 'L2'])
+
     def test_ldscore_fromlist(self):
         fh = os.path.join(DIR, 'parse_test/test')
         x = ps.ldscore_fromlist([fh, fh])
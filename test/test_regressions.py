@@ -3,6 +3,8 @@ import ldscore.regressions as reg
 import unittest
 import numpy as np
 import nose
+import os
+import tempfile
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 from nose.tools import assert_raises, assert_equal
 np.set_printoptions(precision=4)
@@ -42,6 +44,24 @@ def test_append_intercept():
     assert_array_equal(reg.append_intercept(x), correct_x)
 
 
+def test_lazy_design():
+    x = np.random.normal(size=(10, 3))
+    N = np.arange(1, 11, dtype=float).reshape((10, 1))
+    correct_x = reg.append_intercept(np.multiply(N, x) / 5.5)
+    d = reg.LazyDesign(x, N, 5.5, intercept=True)
+    assert_equal(d.shape, (10, 4))
+    assert_array_almost_equal(np.asarray(d), correct_x)
+    assert_array_almost_equal(d[2:5], correct_x[2:5])
+    assert_array_almost_equal(d[:, 0], correct_x[:, 0])
+    rows = np.array([[0, 1], [7, 8]])
+    assert_array_almost_equal(d[rows], correct_x[rows])
+    # a subset of rows, without intercept
+    index = np.array([1, 4, 5, 9])
+    d = reg.LazyDesign(x, N, 5.5, index=index)
+    assert_equal(d.shape, (4, 3))
+    assert_array_almost_equal(d[1:3], correct_x[index[1:3], 0:3])
+
+
 def test_remove_brackets():
     x = ' [] [] asdf [] '
     nose.tools.assert_equal(reg.remove_brackets(x), 'asdf')
@@ -119,6 +139,24 @@ class Test_Hsq_1D(unittest.TestCase):
     def test_update(self):
         pass
 
+    def test_memmap(self):
+        # the design is read from x as needed, so x can be a memmap
+        fname = os.path.join(tempfile.mkdtemp(), 'ld.dat')
+        ld = np.memmap(fname, dtype='float64', mode='w+', shape=self.ld.shape)
+        ld[:] = self.ld + np.arange(4).reshape((4, 1))
+        chisq = self.chisq + np.arange(4).reshape((4, 1))
+        hsq = reg.Hsq(chisq, ld, self.w_ld, self.N, self.M, n_blocks=3)
+        correct = reg.Hsq(chisq, np.array(ld), self.w_ld, self.N, self.M, n_blocks=3)
+        assert_array_almost_equal(hsq.tot, correct.tot)
+        assert_array_almost_equal(hsq.tot_se, correct.tot_se)
+
+    def test_n_iter(self):
+        assert_equal(self.hsq.n_iter, 2)
+        hsq = reg.Hsq(self.chisq, self.ld, self.w_ld, self.N, self.M, n_blocks=3,
+                      intercept=1, irwls_tol=np.inf, irwls_max_iter=4)
+        assert_equal(hsq.n_iter, 1)
+        assert_array_almost_equal(hsq.tot, self.hsq.tot)
+
     def test_aggregate(self):
         chisq = np.ones((10, 1)) * 3 / 2
         ld = np.ones((10, 1)) * 100
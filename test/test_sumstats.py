@@ -11,6 +11,7 @@ from nose.tools import *
 from numpy.testing import assert_array_equal, assert_array_almost_equal, assert_allclose
 from nose.plugins.attrib import attr
 import os
+import tempfile
 
 DIR = os.path.dirname(__file__)
 N_REP = 200
@@ -67,6 +68,38 @@ def test_filter_bad_alleles():
     assert_series_equal(bad_alleles, pd.Series([False, False, False, True]))
 
 
+def test_align_sumstats():
+    d = tempfile.mkdtemp()
+    x1 = pd.DataFrame({'SNP': ['rs1', 'rs2', 'rs3', 'rs5'], 'A1': ['A', 'A', 'C', 'A'],
+                       'A2': ['C', 'G', 'T', 'G'], 'Z': [1.0, 2, 3, 5], 'N': [10.0, 20, 30, 50]})
+    # rs1: ref allele flip, rs2: strand flip, rs3: mismatched alleles, rs4: not in trait 1
+    x2 = pd.DataFrame({'SNP': ['rs4', 'rs3', 'rs2', 'rs1', 'rs6'], 'A1': ['A', 'A', 'T', 'C', 'A'],
+                       'A2': ['G', 'C', 'C', 'A', 'G'], 'Z': [4.0, 3, 2, 1, 6],
+                       'N': [40.0, 30, 20, 10, 60]})
+    paths = [os.path.join(d, str(i)) for i in range(3)]
+    x1.to_csv(paths[0], sep='\t', index=False)
+    x2.to_csv(paths[1], sep='\t', index=False)
+    ref = pd.DataFrame({'SNP': ['rs' + str(i) for i in range(6)]})
+    args = parser.parse_args('')
+    z, N, ok = s._align_sumstats(args, log, paths, ref)
+    assert_equal(ok, [0, 1])
+    nan = np.nan
+    assert_array_equal(z, [[nan, nan, nan], [1, -1, nan], [2, 2, nan], [3, nan, nan],
+                           [nan, 4, nan], [5, nan, nan]])
+    assert_array_equal(N, [[nan, nan, nan], [10, 10, nan], [20, 20, nan], [30, nan, nan],
+                           [nan, 40, nan], [50, nan, nan]])
+    # with --no-check-alleles, mismatched alleles (rs3) are an error for trait 2
+    args.no_check_alleles = True
+    z, N, ok = s._align_sumstats(args, log, paths, ref)
+    assert_equal(ok, [0])
+    assert np.all(np.isnan(z[:, 1]))
+    x2.loc[1, ['A1', 'A2']] = ['C', 'T']
+    x2.to_csv(paths[1], sep='\t', index=False)
+    z, N, ok = s._align_sumstats(args, log, paths, ref)
+    assert_equal(ok, [0, 1])
+    assert_array_equal(z[:, 1], [nan, -1, 2, 3, 4, nan])
+
+
 def test_read_annot():
     ref_ld_chr = None
     ref_ld = os.path.join(DIR, 'annot_test/test')
@@ -403,6 +436,51 @@ class Test_Estimate(unittest.TestCase):
         assert_array_almost_equal(x.prop_se, y.prop_se)
         assert_array_almost_equal(y.coef_se, z.coef_se)
 
+    def test_h2_batch(self):
+        args = parser.parse_args('')
+        args.ref_ld = DIR + '/simulate_test/ldscore/oneld_onefile'
+        args.w_ld = DIR + '/simulate_test/ldscore/w'
+        args.out = DIR + '/simulate_test/1'
+        h2 = []
+        for i in range(3):
+            args.h2 = DIR + '/simulate_test/sumstats/' + str(i)
+            h2.append(s.estimate_h2(args, log))
+
+        args.h2 = ','.join([DIR + '/simulate_test/sumstats/' + str(i) for i in range(3)] +
+                           [DIR + '/simulate_test/sumstats/bad'])
+        for n_jobs in [1, 2]:
+            args.n_jobs = n_jobs
+            x = s.estimate_h2_batch(args, log)
+            assert_equal(len(x), 4)
+            assert_array_almost_equal(x.h2_obs[0:3], [y.tot for y in h2])
+            assert_array_almost_equal(x.h2_obs_se[0:3], [y.tot_se for y in h2])
+            assert_array_almost_equal(x.intercept[0:3], [y.intercept for y in h2])
+            # errors leave the row of the trait blank
+            assert np.isnan(x.h2_obs[3])
+
+    def test_rg_matrix(self):
+        args = parser.parse_args('')
+        args.ref_ld = DIR + '/simulate_test/ldscore/oneld_onefile'
+        args.w_ld = DIR + '/simulate_test/ldscore/w'
+        args.out = DIR + '/simulate_test/1'
+        paths = [DIR + '/simulate_test/sumstats/' + str(i) for i in range(3)]
+        args.rg = ','.join(paths)
+        x = s.estimate_rg(args, log)
+        args.rg = None
+        args.rg_matrix = ','.join(paths + [DIR + '/simulate_test/sumstats/bad'])
+        for n_jobs in [1, 2]:
+            args.n_jobs = n_jobs
+            y = s.estimate_rg_matrix(args, log)
+            for i in range(1, 3):
+                assert_almost_equal(y['rg'].iloc[0, i], x[i - 1].rg_ratio)
+                assert_almost_equal(y['rg_se'].iloc[i, 0], x[i - 1].rg_se)
+                assert_almost_equal(y['gencov'].iloc[0, i], x[i - 1].gencov.tot)
+                assert_almost_equal(y['gencov'].iloc[i, i], x[i - 1].hsq2.tot)
+
+            assert_equal(y['rg'].iloc[1, 1], 1)
+            # errors leave the row and column of the trait blank
+            assert np.all(np.isnan(y['rg'].iloc[3]))
+
     # test statistical properties (constrain intercept here)
     def test_rg_M(self):
         args = parser.parse_args('')